@@ -0,0 +1,204 @@
+""" Benchmarks for the easyrider stages on synthetic bus networks.
+
+The feeds are made by a deterministic generator, so the same arguments always give the same feed.
+Each stage_* function and the EzRider methods behind them are timed, and optionally memory-profiled,
+for growing feed sizes. Results can be saved as a baseline and later runs compared against it:
+
+    python easyrider_benchmarks.py --max-records 100000 --save baseline.json
+    python easyrider_benchmarks.py --max-records 100000 --compare baseline.json
+"""
+import argparse
+import json
+import platform
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+try:
+    import easyrider
+except ImportError:  # run from the project directory, where the module is main.py
+    import main as easyrider
+
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+STREETS = ["Street", "Avenue", "Road", "Boulevard"]
+
+
+def _stop_name(kind, number):
+    """ a stop name that passes the stop_name format, e.g. Tbc Avenue"""
+    letters = ""
+    while True:
+        number, digit = divmod(number, 26)
+        letters += string.ascii_lowercase[digit]
+        if not number:
+            break
+    return f"{kind}{letters} {STREETS[len(letters) % len(STREETS)]}"
+
+
+def _corrupt(record, rng):
+    """ break the type or format of one field of a record"""
+    inp_field = rng.choice(["stop_name", "a_time", "stop_type", "next_stop"])
+    if inp_field == "stop_name":
+        record["stop_name"] = record["stop_name"].lower()
+    elif inp_field == "a_time":
+        record["a_time"] = record["a_time"].replace(":", ".")
+    elif inp_field == "stop_type" and record["stop_type"] not in ("S", "F"):
+        record["stop_type"] = "X"
+    else:
+        record["next_stop"] = str(record["next_stop"])
+
+
+def iter_feed_records(lines, stops_per_line, transfer_share=0.1, error_rate=0.0, seed=0):
+    """ yield the records of a synthetic feed, line after line.
+    every line has a start and a final stop, transfer_share of its other stops come from a pool shared
+    by all lines, and error_rate of the records have one field with a wrong type or format"""
+    rng = random.Random(seed)
+    transfer_pool = max(1, int(lines * stops_per_line * transfer_share) // 2)
+    stop_id = 0
+    for line in range(lines):
+        bus_id = 100 + line
+        minutes = rng.randrange(5 * 60, 9 * 60)
+        for position in range(stops_per_line):
+            stop_id += 1
+            if position == 0:
+                stop_type, stop_name = "S", _stop_name("S", line)
+            elif position == stops_per_line - 1:
+                stop_type, stop_name = "F", _stop_name("F", line)
+            elif rng.random() < transfer_share:
+                stop_type, stop_name = "", _stop_name("T", rng.randrange(transfer_pool))
+            else:
+                stop_type, stop_name = rng.choice(["", "", "", "O"]), _stop_name("L", stop_id)
+            minutes = min(minutes + rng.randrange(1, 10), 23 * 60 + 59)
+            record = {"bus_id": bus_id,
+                      "stop_id": stop_id,
+                      "stop_name": stop_name,
+                      "next_stop": 0 if position == stops_per_line - 1 else stop_id + 1,
+                      "stop_type": stop_type,
+                      "a_time": f"{minutes // 60:02d}:{minutes % 60:02d}"}
+            if error_rate and rng.random() < error_rate:
+                _corrupt(record, rng)
+            yield record
+
+
+def generate_feed(records, stops_per_line=20, transfer_share=0.1, error_rate=0.0, seed=0):
+    """ a synthetic feed with about the given number of records, as a JSON document"""
+    lines = max(1, records // stops_per_line)
+    return json.dumps(list(iter_feed_records(lines, stops_per_line, transfer_share, error_rate, seed)))
+
+
+def _method_target(method_name, *args, **kwargs):
+    """ a benchmark target calling one EzRider method on already parsed records"""
+    def target(user_input, records):
+        ezrider = easyrider.EzRider(records)
+        return getattr(ezrider, method_name)(*args, **kwargs)
+    return target
+
+
+TARGETS = {name: (lambda name: lambda user_input, records: getattr(easyrider, name)(user_input))(name)
+           for name in easyrider.STAGES + ("stage_all",)}
+TARGETS.update({"EzRider.total_report_errors_found": _method_target("total_report_errors_found"),
+                "EzRider.stops_counter": _method_target("stops_counter", stand_alone=True),
+                "EzRider.stops_sepcifier": _method_target("stops_sepcifier"),
+                "EzRider.stops_time_validation": _method_target("stops_time_validation"),
+                "EzRider.validate_on_demand_stops": _method_target("validate_on_demand_stops"),
+                "EzRider.audit": _method_target("audit")})
+
+
+def measure(target, user_input, records, repeat=3, memory=False):
+    """ best wall time of a target over repeat runs, and the peak traced memory of one run"""
+    result = {"seconds": None, "peak_kib": None, "error": None}
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            target(user_input, records)
+        except Exception as error:  # stages stop on bad lines, their cost up to that point is still measured
+            result["error"] = type(error).__name__
+        best = min(best, time.perf_counter() - start)
+    result["seconds"] = best
+    if memory:
+        tracemalloc.start()
+        try:
+            target(user_input, records)
+        except Exception:
+            pass
+        result["peak_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+
+def run(sizes, targets, stops_per_line=20, transfer_share=0.1, error_rate=0.0, seed=0, repeat=3, memory=False):
+    """ benchmark every target on a feed of each size"""
+    results = {}
+    for size in sizes:
+        user_input = generate_feed(size, stops_per_line, transfer_share, error_rate, seed)
+        records = json.loads(user_input)
+        results[str(size)] = {}
+        for name in targets:
+            results[str(size)][name] = measure(TARGETS[name], user_input, records, repeat, memory)
+            print(format_result(size, name, results[str(size)][name]), file=sys.stderr)
+    return results
+
+
+def format_result(size, name, result, baseline=None):
+    line = f"{size:>10} {name:<36} {result['seconds'] * 1000:>12.2f} ms"
+    if result["peak_kib"] is not None:
+        line += f" {result['peak_kib']:>10} KiB"
+    if baseline:
+        line += f"  x{result['seconds'] / baseline['seconds']:.2f} of baseline"
+    if result["error"]:
+        line += f"  ({result['error']})"
+    return line
+
+
+def compare(results, baseline, threshold):
+    """ print every result against the baseline, return the regressions slower than threshold times the baseline"""
+    regressions = []
+    for size, size_results in results.items():
+        for name, result in size_results.items():
+            old = baseline["results"].get(size, {}).get(name)
+            print(format_result(int(size), name, result, old))
+            if old and result["seconds"] > old["seconds"] * threshold:
+                regressions.append((size, name))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the easyrider stages on synthetic feeds")
+    parser.add_argument("--max-records", type=int, default=100_000, help="largest feed size to run")
+    parser.add_argument("--sizes", type=int, nargs="*", help="feed sizes to run, instead of 1k up to --max-records")
+    parser.add_argument("--targets", nargs="*", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--stops-per-line", type=int, default=20)
+    parser.add_argument("--transfer-share", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--memory", action="store_true", help="also trace the peak memory of each target")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="compare the results with this baseline file")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or [size for size in SIZES if size <= args.max_records]
+    results = run(sizes, args.targets, args.stops_per_line, args.transfer_share, args.error_rate, args.seed,
+                  args.repeat, args.memory)
+    report = {"python": platform.python_version(),
+              "generator": {"stops_per_line": args.stops_per_line, "transfer_share": args.transfer_share,
+                            "error_rate": args.error_rate, "seed": args.seed},
+              "results": results}
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for size, name in regressions:
+            print(f"regression: {name} on {size} records")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
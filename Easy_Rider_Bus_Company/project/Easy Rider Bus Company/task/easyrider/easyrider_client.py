@@ -0,0 +1,74 @@
+""" Thin client of the resident easyrider validator.
+
+Starting Python and importing the checker costs more than checking a small feed, so a pipeline that checks many
+feeds can keep a warmed up validator running and send it the feed paths instead:
+
+    python main.py --serve /tmp/easyrider.sock &
+    python easyrider_client.py --socket /tmp/easyrider.sock --stages stage_one,stage_four feeds/
+
+Each call is answered by a process forked from the resident one. The results are printed as NDJSON lines, one per
+feed, as the batch mode of main.py prints them. This module only imports what it needs to talk to the socket.
+"""
+import json
+import os
+import socket
+import sys
+import time
+
+
+def request_validation(socket_path, paths, stages=None):
+    """ yield the result line of every feed, then the server line with its startup and fork times, decoded"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        with connection.makefile("rw") as stream:
+            # the server runs in another directory
+            request = {"paths": [os.path.abspath(path) for path in paths], "stages": stages}
+            stream.write(json.dumps(request) + "\n")
+            stream.flush()
+            for line in stream:
+                yield json.loads(line)
+
+
+def main(argv=None):
+    started = time.perf_counter()
+    usage = "usage: easyrider_client.py --socket SOCKET [--stages STAGES] [--timing] paths..."
+    args = list(sys.argv[1:] if argv is None else argv)
+    socket_path, stages, timing, paths = None, None, False, []
+    while args:
+        arg = args.pop(0)
+        if arg in ("--socket", "--stages") and args:
+            value = args.pop(0)
+            if arg == "--socket":
+                socket_path = value
+            else:
+                stages = [stage for stage in value.split(",") if stage]
+        elif arg == "--timing":
+            timing = True
+        elif arg.startswith("--"):
+            print(usage, file=sys.stderr)
+            return 2
+        else:
+            paths.append(arg)
+    if not socket_path or not paths:
+        print(usage, file=sys.stderr)
+        return 2
+
+    failed = 0
+    for result in request_validation(socket_path, paths, stages):
+        if "error" in result and "path" not in result:
+            print(result["error"], file=sys.stderr)
+            return 2
+        if "server" in result:
+            if timing:
+                server = result["server"]
+                print(f"answered in {(time.perf_counter() - started) * 1000:.1f} ms, the server warmed up in "
+                      f"{server['startup_seconds'] * 1000:.1f} ms and forked the worker in "
+                      f"{server['fork_seconds'] * 1000:.2f} ms", file=sys.stderr)
+            continue
+        failed += "error" in result
+        sys.stdout.write(json.dumps(result) + "\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
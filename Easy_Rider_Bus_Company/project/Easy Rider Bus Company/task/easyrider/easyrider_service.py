@@ -0,0 +1,238 @@
+""" Asyncio validation service for bus company feeds.
+
+Feeds are uploaded over HTTP, on a TCP port or a Unix socket:
+
+    POST /validate?stages=stage_one,stage_four
+    Content-Length: <size of the feed>
+
+    [{"bus_id": 128, ...}, ...]
+
+While the feed is read, the records are validated chunk by chunk and the error counts of every chunk are
+streamed back as NDJSON lines. Once the whole feed is in, the requested stage reports follow in a last line:
+
+    {"chunk": 0, "records": 1000, "errors": {"bus_id": 0, ...}}
+    ...
+    {"records": 4200, "reports": {"stage_one": "...", ...}, "failures": {}, "seconds": 0.42}
+
+The checks run on a pool of worker processes. At most max_concurrent feeds are validated at once, later uploads
+wait before their body is read, and a feed is only read as fast as its chunks are validated and sent back.
+"""
+import argparse
+import asyncio
+import codecs
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import easyrider
+except ImportError:  # run from the project directory, where the module is main.py
+    import main as easyrider
+
+
+def count_chunk_errors(records) -> dict:
+    """ the type and required field errors of a chunk of records"""
+    ezrider = easyrider.EzRider(records)
+    ezrider.total_report_errors_found()
+    return {inp_field: ezrider.total_errors_dict[inp_field] for inp_field in ezrider.fields}
+
+
+def audit_records(records, stages) -> dict:
+    """ the requested stage reports of a feed, and the messages of the stages that failed"""
+    ezrider = easyrider.EzRider(records)
+    reports = ezrider.audit()
+    return {"reports": {stage: reports[stage] for stage in stages if stage in reports},
+            "failures": {stage: str(error) for stage, error in ezrider.audit_failures.items() if stage in stages}}
+
+
+class RequestError(Exception):
+    """ a request the service can not take, with its HTTP status"""
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class ValidationService:
+    """ validates uploaded feeds on a pool of worker processes"""
+
+    def __init__(self, workers=None, max_concurrent=8, max_request_bytes=64 * 1024 * 1024, chunk_records=1000):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrent = max_concurrent
+        self.max_request_bytes = max_request_bytes
+        self.chunk_records = chunk_records
+        self.executor = None
+        self.slots = None
+
+    async def start(self, host="127.0.0.1", port=8080, unix_path=None):
+        """ start serving, on a Unix socket when unix_path is given"""
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+        if unix_path:
+            return await asyncio.start_unix_server(self.handle, path=unix_path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    async def read_request(self, reader):
+        """ the stages and content length of a request, after reading its headers"""
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if len(request_line) != 3:
+            raise RequestError(400, "Bad Request")
+        method, target, _ = request_line
+        url = urlsplit(target)
+        if url.path != "/validate":
+            raise RequestError(404, "Not Found")
+        if method != "POST":
+            raise RequestError(405, "Method Not Allowed")
+        if "content-length" not in headers:
+            raise RequestError(411, "Length Required")
+        content_length = int(headers["content-length"])
+        if content_length < 0:
+            raise RequestError(400, "Bad Request")
+        if content_length > self.max_request_bytes:
+            raise RequestError(413, "Payload Too Large")
+
+        stages = list(easyrider.STAGES)
+        query = parse_qs(url.query)
+        if "stages" in query:
+            stages = [stage for stage in ",".join(query["stages"]).split(",") if stage]
+            unknown = [stage for stage in stages if stage not in easyrider.STAGES]
+            if unknown:
+                raise RequestError(400, f"Unknown stages: {', '.join(unknown)}")
+        return stages, content_length
+
+    async def send_line(self, writer, message):
+        """ send one NDJSON line as an HTTP chunk, waiting while the client is slow to read"""
+        data = (json.dumps(message) + "\n").encode()
+        writer.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                stages, content_length = await self.read_request(reader)
+            except (RequestError, ValueError) as error:
+                status, reason = (error.status, error.reason) if isinstance(error, RequestError) else (400, "Bad Request")
+                body = reason.encode()
+                writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: {len(body)}\r\n"
+                             f"Connection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+                return
+            async with self.slots:
+                await self.validate_upload(reader, writer, stages, content_length)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def validate_upload(self, reader, writer, stages, content_length):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        decoder = easyrider.JsonArrayDecoder()
+        records = []
+        pending = []
+        chunk = 0
+        remaining = content_length
+        try:
+            while True:
+                data = await reader.read(min(65536, remaining)) if remaining else b""
+                remaining -= len(data)
+                final = not remaining or not data
+                pending += decoder.feed(text_decoder.decode(data, final=final), final=final)
+                while len(pending) >= self.chunk_records or (final and pending):
+                    chunk_records, pending = pending[:self.chunk_records], pending[self.chunk_records:]
+                    errors = await loop.run_in_executor(self.executor, count_chunk_errors, chunk_records)
+                    await self.send_line(writer, {"chunk": chunk, "records": len(chunk_records), "errors": errors})
+                    records += chunk_records
+                    chunk += 1
+                if final:
+                    break
+            result = await loop.run_in_executor(self.executor, audit_records, records, stages)
+            await self.send_line(writer, dict(result, records=len(records), seconds=time.perf_counter() - start))
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            # a feed that is not an array of record objects ends its answer with the error, like a broken one
+            await self.send_line(writer, {"error": f"{type(error).__name__}: {error}"})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def submit_feed(feed, stages=None, host="127.0.0.1", port=8080, unix_path=None):
+    """ upload a feed to the service and return the NDJSON lines of its answer, decoded"""
+    if unix_path:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    body = feed.encode()
+    target = "/validate" + (f"?stages={','.join(stages)}" if stages else "")
+    writer.write(f"POST {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+
+    status_line = (await reader.readline()).decode("latin-1")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if " 200 " not in status_line:
+        body = await reader.read()
+        writer.close()
+        raise RequestError(int(status_line.split()[1]), body.decode())
+
+    data = b""
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        if not size:
+            break
+        data += await reader.readexactly(size + 2)
+        data = data[:-2]
+    writer.close()
+    return [json.loads(line) for line in data.decode().splitlines()]
+
+
+async def serve(service, host, port, unix_path):
+    server = await service.start(host, port, unix_path)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="serve feed validation over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="feeds validated at the same time")
+    parser.add_argument("--max-request-bytes", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--chunk-records", type=int, default=1000, help="records per partial result")
+    args = parser.parse_args(argv)
+
+    service = ValidationService(args.workers, args.max_concurrent, args.max_request_bytes, args.chunk_records)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
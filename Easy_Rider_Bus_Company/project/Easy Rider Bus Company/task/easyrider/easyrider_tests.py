@@ -1,5 +1,15 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import signal
+import tempfile
 import unittest
 import easyrider
+import easyrider_benchmarks
+import easyrider_client
+import easyrider_service
 from easyrider import BadBusException
 
 
@@ -568,6 +578,21 @@ stage_six_input2 = """[{"bus_id" : 128, "stop_id" : 1, "stop_name" : "Prospekt A
 stage_six_output2 = """On demand stops test:
 Wrong stop type: ['Abbey Road', 'Elm Street']"""
 
+ALL_INPUTS = [stage_1_input, STAGE_TWO_INPUT, STAGE_THREE_INPUT, STAGE_FOUR_INPUT, STAGE_FOUR_INPUT2,
+              stage_five_input, stage_five_input2, stage_five_input3, stage_six_input, stage_six_input2]
+
+
+def run_stages(user_input):
+    """ the report of every stage run on its own, or the exception that stopped it"""
+    reports = {}
+    for stage in easyrider.STAGES:
+        try:
+            reports[stage] = getattr(easyrider, stage)(user_input)
+        except Exception as error:
+            reports[stage] = type(error)
+    return reports
+
+
 class TestEasyRider(unittest.TestCase):
     # def test_to_c_what_happens(self):
     #     self.assertTrue(easyrider.wat('apple', 'pineapple pie'))
@@ -612,5 +637,654 @@ class TestEasyRider(unittest.TestCase):
     def test_stage_six2(self):
         output = easyrider.stage_six(stage_six_input2)
         self.assertEqual(stage_six_output2, output, 'custom message')
+
+    def test_iter_json_records(self):
+        """ records streamed in small chunks match a whole-document parse"""
+        records = list(easyrider.iter_json_records(io.StringIO(stage_six_input2), chunk_size=7))
+        self.assertEqual(json.loads(stage_six_input2), records)
+        self.assertEqual([], list(easyrider.iter_json_records(io.StringIO(" [ ] "))))
+        for user_input in ALL_INPUTS:
+            self.assertEqual(json.loads(user_input), list(easyrider.iter_json_records(io.StringIO(user_input), 1)))
+        # a malformed record is reported as soon as it is read, not at the end of the feed
+        decoder = easyrider.JsonArrayDecoder()
+        self.assertEqual([{"bus_id": 1}], decoder.feed('[{"bus_id": 1}, {"bus_id": "12'))
+        with self.assertRaises(json.JSONDecodeError):
+            decoder.feed('8", "stop_id": tru, "next_stop": 3}, ')
+
+    def test_streamed_stages(self):
+        """ stages fed a text stream give the same reports as stages fed a string"""
+        self.assertEqual(STAGE_ONE_OUTPUT, easyrider.stage_one(io.StringIO(stage_1_input)))
+        self.assertEqual(STAGE_THREE_OUTPUT, easyrider.stage_three(io.StringIO(STAGE_THREE_INPUT)))
+        self.assertEqual(stage_five_output, easyrider.stage_five(io.StringIO(stage_five_input)))
+        self.assertEqual(stage_six_output, easyrider.stage_six(io.StringIO(stage_six_input)))
+
+    def test_stage_all(self):
+        """ the single pass audit matches every stage run on its own"""
+        for user_input in ALL_INPUTS:
+            expected = run_stages(user_input)
+            ezrider = easyrider.EzRider(user_input)
+            reports = ezrider.audit()
+            for stage in easyrider.STAGES:
+                if stage in ezrider.audit_failures:
+                    self.assertIs(expected[stage], type(ezrider.audit_failures[stage]))
+                else:
+                    self.assertEqual(expected[stage], reports[stage])
+        reports = easyrider.stage_all(STAGE_FOUR_INPUT2)
+        self.assertEqual(list(easyrider.STAGES), list(reports))
+        self.assertEqual(STAGE_THREE_OUTPUT, easyrider.stage_all(STAGE_THREE_INPUT)["stage_three"])
+
+    def test_field_validators(self):
+        """ the validator table accepts and rejects the documented formats"""
+        ezrider = easyrider.EzRider("[]")
+        for value in ["08:12", "00:00", "23:59"]:
+            self.assertTrue(ezrider.check_data_types("a_time", value))
+        for value in ["24:00", "8:12", "08:60", "08:12 ", 8.12, ""]:
+            self.assertFalse(ezrider.check_data_types("a_time", value))
+        for value in ["", "S", "O", "F", " "]:
+            self.assertTrue(ezrider.check_data_types("stop_type", value))
+        for value in ["s", "SO", "A", 1, None]:
+            self.assertFalse(ezrider.check_data_types("stop_type", value))
+        self.assertTrue(ezrider.check_data_types("stop_name", "Sunset Boulevard"))
+        self.assertFalse(ezrider.check_data_types("stop_name", "Sunset boulevard"))
+        self.assertTrue(ezrider.check_data_types("bus_id", 128))
+        self.assertFalse(ezrider.check_data_types("bus_id", "128"))
+
+    @unittest.skipIf(easyrider.np is None, "numpy is not installed")
+    def test_columnar_store(self):
+        """ the vectorized checks of the columnar store give the same reports"""
+        for user_input, stage_output in [(stage_1_input, STAGE_ONE_OUTPUT), (STAGE_TWO_INPUT, STAGE_TWO_OUTPUT)]:
+            columns = easyrider.EzRider(user_input).columnar_store()
+            columns.total_report_errors_found()
+            stage = "stage_one" if stage_output == STAGE_ONE_OUTPUT else "stage_two"
+            self.assertEqual(stage_output, easyrider.report_format(stage, columns, tot_err=columns.get_tot_error()))
+
+        columns = easyrider.EzRider(STAGE_THREE_INPUT).columnar_store()
+        self.assertEqual(STAGE_THREE_OUTPUT,
+                         easyrider.report_format("stage_three", columns, stops_report=columns.stops_counter()))
+
+        for user_input, stage_output in [(stage_five_input, stage_five_output), (stage_five_input2, stage_five_output2),
+                                         (stage_five_input3, stage_five_output3)]:
+            columns = easyrider.EzRider(user_input).columnar_store()
+            columns.stops_time_validation()
+            self.assertEqual(stage_output, easyrider.report_format("stage_five", columns))
+
+        # a stop name that is not a string is reported as it is in the feed
+        records = [{"bus_id": 128, "stop_id": 1, "stop_name": "Prospekt Avenue", "next_stop": 3, "stop_type": "S",
+                    "a_time": "08:12"},
+                   {"bus_id": 128, "stop_id": 3, "stop_name": 7, "next_stop": 0, "stop_type": "F",
+                    "a_time": "08:10"}]
+        ezrider = easyrider.EzRider(json.dumps(records))
+        columns = ezrider.columnar_store()
+        self.assertEqual({128: 7}, columns.stops_time_validation())
+        self.assertEqual({128: 7}, {bus_id: stop_name for bus_id, stop_name in ezrider.stops_time_validation().items()
+                                     if stop_name})
+
+    def test_stop_lines_index(self):
+        """ the stop -> lines index answers transfer queries after stops_sepcifier"""
+        ezrider = easyrider.EzRider(STAGE_FOUR_INPUT)
+        report = ezrider.stops_sepcifier()
+        for stop_name in report["T"]:
+            self.assertGreater(ezrider.line_count(stop_name), 1)
+        self.assertEqual({128, 256}, ezrider.lines_serving("Elm Street"))
+        self.assertEqual(0, ezrider.line_count("Nowhere Street"))
+
+    def test_stage_all_parallel(self):
+        """ the audit sharded by bus_id over worker processes matches the serial audit"""
+        for user_input in ALL_INPUTS:
+            self.assertEqual(easyrider.stage_all(user_input), easyrider.stage_all(user_input, workers=2))
+
+    def test_synthetic_feed(self):
+        """ the benchmark generator is deterministic and its clean feeds pass every stage"""
+        feed = easyrider_benchmarks.generate_feed(200, stops_per_line=10, transfer_share=0.3, seed=7)
+        self.assertEqual(feed, easyrider_benchmarks.generate_feed(200, stops_per_line=10, transfer_share=0.3, seed=7))
+        self.assertEqual(200, len(json.loads(feed)))
+        reports = easyrider.stage_all(feed)
+        self.assertTrue(reports["stage_one"].startswith("Type and required field validation: 0 errors"))
+        self.assertTrue(reports["stage_four"].startswith("Start stops: 20 "))
+        self.assertEqual("Arrival time test:\nOK", reports["stage_five"])
+        feed = easyrider_benchmarks.generate_feed(200, stops_per_line=10, error_rate=0.2, seed=7)
+        self.assertFalse(easyrider.stage_one(feed).startswith("Type and required field validation: 0 errors"))
+
+    def test_incremental_changes(self):
+        """ revalidating the touched lines gives the same reports as a full audit of the edited feed"""
+        for user_input in ALL_INPUTS:
+            ezrider = easyrider.EzRider(user_input)
+            self.assertEqual(easyrider.EzRider(user_input).audit(), ezrider.start_incremental())
+
+        records = json.loads(stage_six_input2)
+        ezrider = easyrider.EzRider(stage_six_input2)
+        ezrider.start_incremental()
+        # Abbey Road stops being a transfer stop once line 512 goes
+        reports = ezrider.apply_changes(deletes=[(512, 4), (512, 6)])
+        edited = [record for record in records if record["bus_id"] != 512]
+        self.assertEqual(easyrider.EzRider(edited).audit(), reports)
+        self.assertEqual("On demand stops test:\nWrong stop type: ['Elm Street']", reports["stage_six"])
+
+        late = dict(records[2], a_time="08:10")
+        new_line = [dict(records[8], bus_id=1024), dict(records[9], bus_id=1024)]
+        reports = ezrider.apply_changes(upserts=[late] + new_line)
+        edited = [late if record is records[2] else record for record in edited] + new_line
+        self.assertEqual(easyrider.EzRider(edited).audit(), reports)
+        self.assertIn("bus_id line 128: wrong time on station Fifth Avenue", reports["stage_five"])
+
+        # an updated stop keeps its place in the feed, a new one goes after the records of the feed
+        records = json.loads(stage_six_input)
+        without_stop = [dict(record, next_stop=7) if record["stop_id"] == 3 and record["bus_id"] == 128 else record
+                        for record in records if (record["bus_id"], record["stop_id"]) != (128, 5)]
+        ezrider = easyrider.EzRider(without_stop)
+        ezrider.start_incremental()
+        reports = ezrider.apply_changes(upserts=[records[1], records[2]])
+        edited = [records[1] if (record["bus_id"], record["stop_id"]) == (128, 3) else record
+                  for record in without_stop] + [records[2]]
+        self.assertEqual(easyrider.EzRider(edited).audit(), reports)
+        self.assertIn("bus_id line 128: wrong time on station Fifth Avenue", reports["stage_five"])
+
+        # the stops of a line are checked in record order, as the stages do, not in next_stop order
+        records_out_of_route = [
+            {"bus_id": 128, "stop_id": 1, "stop_name": "Prospekt Avenue", "next_stop": 2, "stop_type": "S",
+             "a_time": "08:00"},
+            {"bus_id": 128, "stop_id": 3, "stop_name": "Sesame Street", "next_stop": 0, "stop_type": "F",
+             "a_time": "08:20"},
+            {"bus_id": 128, "stop_id": 2, "stop_name": "Fifth Avenue", "next_stop": 3, "stop_type": "",
+             "a_time": "08:10"}]
+        user_input = json.dumps(records_out_of_route)
+        reports = easyrider.EzRider(user_input).start_incremental()
+        self.assertEqual(easyrider.EzRider(user_input).audit(), reports)
+        self.assertEqual(easyrider.stage_five(user_input), reports["stage_five"])
+        self.assertIn("wrong time on station Fifth Avenue", reports["stage_five"])
+
+        # records repeating a stop are all kept
+        repeated = records + [dict(records[5], stop_name="elm street"), dict(records[5], a_time="9:45")]
+        self.assertEqual(easyrider.EzRider(repeated).audit(), easyrider.EzRider(repeated).start_incremental())
+
+    def test_result_cache(self):
+        """ repeated stages on the same feed are answered from the cache, failing stages still raise"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = easyrider.use_result_cache(directory)
+            try:
+                self.assertEqual(STAGE_THREE_OUTPUT, easyrider.stage_three(STAGE_THREE_INPUT))
+                self.assertEqual(1, len(os.listdir(directory)))
+                self.assertEqual(STAGE_THREE_OUTPUT, easyrider.stage_three(STAGE_THREE_INPUT))
+                self.assertEqual(STAGE_FOUR_OUTPUT, easyrider.stage_four(STAGE_FOUR_INPUT))
+                self.assertEqual(run_stages(STAGE_FOUR_INPUT2), run_stages(STAGE_FOUR_INPUT2))
+                self.assertRaises(BadBusException, easyrider.stage_four, STAGE_FOUR_INPUT2)
+                self.assertEqual(3, len(os.listdir(directory)))
+
+                cache.max_bytes = 0
+                cache.evict()
+                self.assertEqual([], os.listdir(directory))
+            finally:
+                easyrider.use_result_cache(None)
+
+    def test_profiling(self):
+        """ the profiler counts validator calls and stage methods, and dumps them as JSON"""
+        ezrider = easyrider.EzRider(stage_six_input, profile=True)
+        ezrider.validate_on_demand_stops()
+        report = ezrider.profiler.report()
+        records = len(json.loads(stage_six_input))
+        self.assertEqual(records, report["json_parse"]["records"])
+        self.assertEqual(1, report["validate_on_demand_stops"]["calls"])
+        self.assertEqual(1, report["find_transfer_stops"]["calls"])
+        self.assertGreaterEqual(report["_stop_name"]["calls"], records)
+        dump = io.StringIO()
+        ezrider.profiler.dump(dump)
+        self.assertEqual(report, json.loads(dump.getvalue()))
+
+        streamed = easyrider.EzRider(io.StringIO(stage_six_input), profile=True)
+        streamed.total_report_errors_found()
+        self.assertEqual(records, streamed.profiler.report()["json_parse"]["calls"])
+        self.assertIsNone(easyrider.EzRider(stage_six_input).profiler)
+
+    def test_line_topology(self):
+        """ the per line index holds the route of every line"""
+        topology = easyrider.EzRider(STAGE_FOUR_INPUT).line_topology_index()
+        line = topology[128]
+        self.assertEqual([1, 3, 5, 7], line.stop_ids)
+        self.assertEqual(["Prospekt Avenue", "Elm Street", "Fifth Avenue", "Sesame Street"], line.stop_names)
+        self.assertEqual(["S", "", "O", "F"], line.stop_types)
+        self.assertEqual(("Prospekt Avenue", "Sesame Street"), (line.start_stop, line.final_stop))
+        self.assertIsNone(line.route_fault)
+
+    def test_route_graph(self):
+        """ the next_stop links give the route order, whatever the order of the records"""
+        records = json.loads(stage_five_input3)
+        # the lines keep their order, the stops of each line come backwards
+        lines = list(dict.fromkeys(record["bus_id"] for record in records))
+        shuffled = sorted(records, key=lambda record: (lines.index(record["bus_id"]), -record["stop_id"]))
+        ezrider = easyrider.EzRider(shuffled)
+        ezrider.stops_time_validation(route_order=True)
+        self.assertEqual(stage_five_output3, easyrider.report_format("stage_five", ezrider))
+        self.assertEqual({}, easyrider.EzRider(records).route_faults())
+        if easyrider.np is not None:
+            columns = easyrider.EzRider(shuffled).columnar_store()
+            columns.stops_time_validation(route_order=True)
+            self.assertEqual(stage_five_output3, easyrider.report_format("stage_five", columns))
+            columns.stops_time_validation()
+            self.assertNotEqual(stage_five_output3, easyrider.report_format("stage_five", columns))
+
+        route = easyrider.EzRider(shuffled).route_graph_index()[128]
+        self.assertTrue(route.is_valid)
+        self.assertEqual(list(range(7, -1, -1)), route.order)
+
+        faulty = [{"bus_id": 1, "stop_id": 1, "stop_name": "Elm Street", "next_stop": 2, "stop_type": "S", "a_time": "08:00"},
+                  {"bus_id": 1, "stop_id": 2, "stop_name": "Abbey Road", "next_stop": 9, "stop_type": "F", "a_time": "08:10"},
+                  {"bus_id": 1, "stop_id": 3, "stop_name": "Fifth Avenue", "next_stop": 0, "stop_type": "", "a_time": "08:20"},
+                  {"bus_id": 2, "stop_id": 4, "stop_name": "Elm Street", "next_stop": 5, "stop_type": "", "a_time": "09:00"},
+                  {"bus_id": 2, "stop_id": 5, "stop_name": "Abbey Road", "next_stop": 4, "stop_type": "", "a_time": "09:10"}]
+        routes = easyrider.EzRider(faulty).route_graph_index()
+        self.assertEqual([(2, 9)], routes[1].dangling)
+        self.assertEqual([3], routes[1].orphans)
+        self.assertTrue(routes[1].broken)
+        self.assertTrue(routes[2].cycle)
+        self.assertEqual([1, 2], sorted(easyrider.EzRider(faulty).route_faults()))
+
+    def test_validation_service(self):
+        """ concurrent uploads get their chunk error counts streamed, then the stage reports"""
+        async def upload_feeds():
+            service = easyrider_service.ValidationService(workers=1, max_concurrent=2, max_request_bytes=4096,
+                                                          chunk_records=4)
+            server = await service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                answers = await asyncio.gather(
+                    easyrider_service.submit_feed(stage_1_input, port=port),
+                    easyrider_service.submit_feed(STAGE_THREE_INPUT, ["stage_three"], port=port),
+                    easyrider_service.submit_feed(stage_six_input2, ["stage_six"], port=port))
+                with self.assertRaises(easyrider_service.RequestError) as too_large:
+                    await easyrider_service.submit_feed(" " * 5000, port=port)
+                self.assertEqual(413, too_large.exception.status)
+                for feed in ("[1, 2]", '["Elm Street"]', "[{"):
+                    answer = await easyrider_service.submit_feed(feed, port=port)
+                    self.assertEqual(["error"], list(answer[-1]))
+                # a negative length must not read the body up to the end of the stream
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"POST /validate HTTP/1.1\r\nContent-Length: -1\r\n\r\n" + b" " * 5000)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), 5)
+                writer.close()
+                self.assertIn(b" 400 ", status_line)
+            finally:
+                server.close()
+                await server.wait_closed()
+                service.close()
+            return answers
+
+        first, third, sixth = asyncio.run(upload_feeds())
+        records = len(json.loads(stage_1_input))
+        self.assertEqual([4, 4, records - 8], [line["records"] for line in first[:-1]])
+        total_errors = sum(sum(line["errors"].values()) for line in first[:-1])
+        self.assertEqual(STAGE_ONE_OUTPUT, first[-1]["reports"]["stage_one"])
+        self.assertIn(f"{total_errors} errors", first[-1]["reports"]["stage_one"])
+        self.assertEqual({"stage_three": STAGE_THREE_OUTPUT}, third[-1]["reports"])
+        self.assertEqual({"stage_six": stage_six_output2}, sixth[-1]["reports"])
+
+    def test_batch_validation(self):
+        """ a directory of feeds gives one NDJSON line per feed, bad feeds included"""
+        with tempfile.TemporaryDirectory() as directory:
+            feeds = {"good.json": STAGE_FOUR_INPUT, "bad_bus.json": STAGE_FOUR_INPUT2, "broken.json": "[{",
+                     "values.json": '[["a"], "x"]'}
+            for file_name, feed in feeds.items():
+                with open(os.path.join(directory, file_name), "w") as feed_file:
+                    feed_file.write(feed)
+            output = io.StringIO()
+            failed = easyrider.run_batch([directory], ["stage_three", "stage_four"], workers=2, output=output)
+            results = {os.path.basename(result["path"]): result
+                       for result in map(json.loads, output.getvalue().splitlines())}
+
+        self.assertEqual(2, failed)
+        self.assertEqual(set(feeds), set(results))
+        self.assertEqual({"stage_three": easyrider.stage_three(STAGE_FOUR_INPUT), "stage_four": STAGE_FOUR_OUTPUT},
+                         results["good.json"]["reports"])
+        self.assertIn("BadBusException", results["bad_bus.json"]["failures"]["stage_four"])
+        self.assertIn("JSONDecodeError", results["broken.json"]["error"])
+        self.assertIn("AttributeError", results["values.json"]["error"])
+
+    def test_compact_records(self):
+        """ StopRecord objects decoded by the object hook go through every check like dicts"""
+        for user_input in ALL_INPUTS:
+            compact = easyrider.EzRider(user_input, compact=True)
+            self.assertEqual(easyrider.EzRider(user_input).audit(), compact.audit())
+            self.assertEqual(json.loads(user_input), list(compact.parsed_input))
+
+        ezrider = easyrider.EzRider(stage_six_input, compact=True)
+        self.assertIsInstance(ezrider.parsed_input[0], easyrider.StopRecord)
+        ezrider.validate_on_demand_stops()
+        self.assertEqual(stage_six_output, easyrider.report_format("stage_six", ezrider))
+        streamed = easyrider.EzRider(io.StringIO(STAGE_THREE_INPUT), compact=True)
+        self.assertEqual(STAGE_THREE_OUTPUT, easyrider.report_format(
+            "stage_three", streamed, stops_report=streamed.stops_counter(stand_alone=True)))
+        self.assertEqual(easyrider.stage_all(stage_six_input2),
+                         easyrider.EzRider(stage_six_input2, compact=True).audit_parallel(workers=2))
+        self.assertRaises(KeyError, lambda: ezrider.parsed_input[0]["route"])
+
+        # the ids that repeat in a document share a single int
+        records = easyrider.EzRider(easyrider_benchmarks.generate_feed(1000, seed=1), compact=True).parsed_input
+        stop_ids = {record.stop_id: record.stop_id for record in records}
+        self.assertTrue(all(record.next_stop is stop_ids[record.next_stop]
+                            for record in records if record.next_stop in stop_ids))
+        self.assertTrue(all(record.bus_id is records[0].bus_id for record in records
+                            if record.bus_id == records[0].bus_id))
+        self.assertEqual(json.loads(easyrider_benchmarks.generate_feed(1000, seed=1)), list(records))
+
+    def test_timing_statistics(self):
+        """ travel time quantiles per line and segment, and merging the statistics of shards"""
+        records = json.loads(stage_five_input3)
+        ezrider = easyrider.EzRider(records)
+        timing_stats = ezrider.timing_statistics()
+        # line 128: 08:12 08:19 08:25 08:37 09:20 09:45 09:59 10:12
+        self.assertEqual(120, timing_stats.line_durations[128])
+        self.assertEqual({"count": 7, "min": 6, "median": 13, "p95": 43, "p99": 43, "max": 43},
+                         timing_stats.line_sketches[128].summary())
+        self.assertEqual(3, timing_stats.segment_sketches[("Pilotow Street", "Startowa Street")].quantile(0.5))
+        self.assertEqual(-1, timing_stats.line_durations[1024])
+        report = easyrider.stage_timing(stage_five_input3)
+        self.assertTrue(report.startswith("Travel time statistics:\nbus_id line 128: duration 120 min"))
+
+        shards = [easyrider.EzRider([record for record in records if (record["bus_id"] == 256) == in_shard])
+                  for in_shard in (False, True)]
+        shards = [shard.timing_statistics() for shard in shards]
+        merged = shards[0].merge(shards[1])
+        self.assertEqual(timing_stats.line_durations, {bus_id: merged.line_durations[bus_id]
+                                                      for bus_id in timing_stats.line_durations})
+        self.assertEqual(timing_stats.all_segments_sketch().summary(), merged.all_segments_sketch().summary())
+        self.assertEqual(timing_stats.duration_sketch.summary(), merged.duration_sketch.summary())
+
+    def test_network_snapshot(self):
+        """ a saved network reopens through mmap with the same lines, stops and classifications"""
+        ezrider = easyrider.EzRider(STAGE_FOUR_INPUT)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "network.ezrs")
+            easyrider.save_snapshot(ezrider, path)
+            with easyrider.NetworkSnapshot(path) as snapshot:
+                records = json.loads(STAGE_FOUR_INPUT)
+                self.assertEqual(sorted({record["bus_id"] for record in records}), snapshot.lines())
+                self.assertEqual([record for record in records if record["bus_id"] == 256], snapshot.line_stops(256))
+                self.assertEqual(len(records), len(list(snapshot.records())))
+                self.assertEqual(("Prospekt Avenue", "Sesame Street"), snapshot.line_ends(128))
+                self.assertIsNone(snapshot.line_ends(1024))
+                self.assertEqual([], snapshot.line_stops(1024))
+                self.assertEqual([128, 256], snapshot.lines_serving("Elm Street"))
+                self.assertEqual({"T", "F"}, snapshot.stop_classification("Sesame Street"))
+                self.assertEqual(set(), snapshot.stop_classification("Nowhere Street"))
+                for stop_type, stop_names in ezrider.stops_sepcifier_report.items():
+                    for stop_name in stop_names:
+                        self.assertIn(stop_type, snapshot.stop_classification(stop_name))
+            self.assertRaises(BadBusException, easyrider.save_snapshot, easyrider.EzRider(STAGE_FOUR_INPUT2), path)
+
+    def test_stop_directory(self):
+        """ the stop directory classifies stops and lists their lines"""
+        directory = easyrider.EzRider(STAGE_FOUR_INPUT).stop_directory()
+        self.assertEqual(frozenset({"T", "F"}), directory.classification("Sesame Street"))
+        self.assertTrue(directory.is_start("Pilotow Street"))
+        self.assertFalse(directory.is_transfer("Pilotow Street"))
+        self.assertTrue(directory.is_finish("Sunset Boulevard"))
+        self.assertFalse(directory.is_route_stop("Fifth Avenue"))
+        self.assertIn("Fifth Avenue", directory)
+        self.assertEqual(frozenset({128, 256}), directory.lines_serving("Elm Street"))
+        self.assertEqual(frozenset(), directory.lines_serving("Nowhere Street"))
+        self.assertRaises(AttributeError, setattr, directory, "lines", {})
+
+        ezrider = easyrider.EzRider(stage_six_input2)
+        ezrider.audit()
+        self.assertTrue(ezrider.stops_directory.is_transfer("Abbey Road"))
+
+    def test_report_writer(self):
+        """ reports streamed as text, JSON, NDJSON and CSV"""
+        ezrider = easyrider.EzRider(STAGE_FOUR_INPUT)
+        ezrider.stops_sepcifier()
+        ezrider.validate_on_demand_stops()
+
+        stream = io.StringIO()
+        with easyrider.ReportWriter(stream) as writer:
+            writer.write_report("stage_four", ezrider)
+        self.assertEqual(easyrider.stage_four(STAGE_FOUR_INPUT) + "\n", stream.getvalue())
+
+        stream = io.StringIO()
+        with easyrider.ReportWriter(stream, "json") as writer:
+            writer.write_report("stage_four", ezrider)
+            writer.write_report("stage_six", ezrider)
+        reports = json.loads(stream.getvalue())
+        self.assertEqual(["stage_four", "stage_six"], [report["stage"] for report in reports])
+        self.assertEqual({"stop_type": "S", "stop_name": "Bourbon Street"}, reports[0]["rows"][0])
+        self.assertEqual(8, len(reports[0]["rows"]))
+
+        stream = io.StringIO()
+        with easyrider.ReportWriter(stream, "ndjson") as writer:
+            writer.write_report("stage_four", ezrider)
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual({"stage": "stage_four", "stop_type": "F", "stop_name": "Sunset Boulevard"}, rows[-1])
+
+        stream = io.StringIO()
+        with easyrider.ReportWriter(stream, "csv") as writer:
+            writer.write_report("stage_three", ezrider, stops_report=ezrider.stops_counter(stand_alone=True))
+            writer.write_report("stage_four", ezrider)
+            writer.write_report("stage_six", ezrider)
+        stream.seek(0)
+        reader = csv.DictReader(stream)
+        rows = list(reader)
+        self.assertEqual(list(easyrider.ReportWriter.csv_columns), reader.fieldnames)
+        self.assertEqual({"stage": "stage_three", "field": "", "errors": "", "bus_id": "128", "stops": "4",
+                          "stop_type": "", "stop_name": ""}, rows[0])
+        stage_four = [row for row in rows if row["stage"] == "stage_four"]
+        self.assertEqual(8, len(stage_four))
+        self.assertEqual(("S", "Bourbon Street"), (stage_four[0]["stop_type"], stage_four[0]["stop_name"]))
+        # stage six found no wrong stop types, which is told apart from a stage that did not run
+        self.assertEqual([{"stage": "stage_six", **dict.fromkeys(easyrider.ReportWriter.csv_columns[1:], "")}],
+                         [row for row in rows if row["stage"] == "stage_six"])
+
+        stream = io.StringIO()
+        easyrider.ReportWriter(stream, "csv").close()
+        self.assertEqual("stage,field,errors,bus_id,stops,stop_type,stop_name\n", stream.getvalue())
+
+        with self.assertRaises(ValueError):
+            easyrider.ReportWriter(io.StringIO(), "xml")
+
+    def test_error_details(self):
+        """ error counts, first indexes and samples per field, the same from a serial and a sharded audit"""
+        ezrider = easyrider.EzRider(stage_1_input, error_samples=2, first_errors=3)
+        ezrider.total_report_errors_found()
+        details = ezrider.error_details_report()
+        for key, detail in details.items():
+            inp_field, error_kind = key.split(".")
+            counter = ezrider.data_type_errors if error_kind == "type" else ezrider.error_counter
+            self.assertEqual(counter[inp_field], detail["count"])
+            self.assertLessEqual(len(detail["sample"]), 2)
+            self.assertEqual(sorted(detail["first_indexes"]), detail["first_indexes"])
+        self.assertEqual(sum(ezrider.total_errors_dict.values()),
+                         sum(detail["count"] for detail in details.values()))
+
+        records = json.loads(easyrider_benchmarks.generate_feed(2000, error_rate=0.2, seed=1))
+        serial = easyrider.EzRider(records, error_samples=5)
+        serial.audit()
+        sharded = easyrider.EzRider(records, error_samples=5)
+        sharded.audit_parallel(workers=2, shards=4)
+        self.assertEqual(serial.error_details_report(), sharded.error_details_report())
+        a_time_errors = serial.error_details_report()["a_time.type"]
+        self.assertEqual(5, len(a_time_errors["sample"]))
+        self.assertEqual([records[index]["a_time"] for index, _ in a_time_errors["sample"]],
+                         [value for _, value in a_time_errors["sample"]])
+
+        # samples without first indexes
+        ezrider = easyrider.EzRider(stage_1_input, error_samples=3, first_errors=0)
+        ezrider.total_report_errors_found()
+        details = ezrider.error_details_report()
+        for detail in details.values():
+            self.assertEqual([], detail["first_indexes"])
+            self.assertEqual(min(3, detail["count"]), len(detail["sample"]))
+        self.assertEqual(sum(ezrider.total_errors_dict.values()), sum(detail["count"] for detail in details.values()))
+
+        # no samples turns the error details off
+        ezrider = easyrider.EzRider(stage_1_input, error_samples=0, first_errors=3)
+        ezrider.total_report_errors_found()
+        self.assertIsNone(ezrider.error_details)
+        self.assertEqual({}, ezrider.error_details_report())
+
+    def test_compiled_schema(self):
+        """ the compiled record checker counts the same errors as the checks field by field"""
+        records = json.loads(easyrider_benchmarks.generate_feed(500, error_rate=0.3, seed=2))
+        records[3] = dict(records[3], stop_name="")
+        del records[7]["stop_type"]
+        for user_input in ALL_INPUTS + [records]:
+            compiled = easyrider.EzRider(user_input)
+            compiled.total_report_errors_found()
+            by_field = easyrider.EzRider(user_input)
+            by_field.record_checker = None
+            by_field.total_report_errors_found()
+            self.assertEqual(by_field.total_errors_dict, compiled.total_errors_dict)
+        self.assertIs(easyrider.compile_schema(easyrider.DEFAULT_SCHEMA, 0), compiled.record_checker)
+
+        # an agency with required stop types, times with seconds and a fare zone
+        schema = [schema_field for schema_field in easyrider.DEFAULT_SCHEMA if schema_field.name != "a_time"]
+        schema[4] = easyrider.SchemaField("stop_type", str, required=True, values=frozenset(["", "S", "O", "F"]))
+        schema += [easyrider.SchemaField("a_time", str, required=True, format=r"([01]\d|2[0-3])(:[0-5]\d){2}"),
+                   easyrider.SchemaField("zone", int)]
+        feed = [{"bus_id": 1, "stop_id": 1, "stop_name": "Elm Street", "next_stop": 2, "stop_type": "S",
+                 "a_time": "08:12:30", "zone": 1},
+                {"bus_id": 1, "stop_id": 2, "stop_name": "Abbey Road", "next_stop": 0, "stop_type": "",
+                 "a_time": "08:20", "zone": "A"}]
+        ezrider = easyrider.EzRider(feed, schema=schema)
+        self.assertEqual(0, ezrider.record_checker(feed[0]))
+        ezrider.total_report_errors_found()
+        self.assertEqual({"stop_type": 1, "a_time": 1, "zone": 1}, dict(ezrider.total_errors_dict))
+        self.assertTrue(ezrider.check_data_types("a_time", "23:59:59"))
+        self.assertFalse(ezrider.check_data_types("a_time", "23:59"))
+
+        # the workers of the parallel audit and the lines of the incremental one check with the same schema
+        schema = list(easyrider.DEFAULT_SCHEMA) + [easyrider.SchemaField("zone", int)]
+        records = [dict(record, zone=index % 3 or "A") for index, record in enumerate(json.loads(stage_six_input))]
+        serial = easyrider.EzRider(records, schema=schema, error_samples=2)
+        reports = serial.audit()
+        self.assertIn("zone: 4", reports["stage_one"])
+        parallel = easyrider.EzRider(records, schema=schema, error_samples=2)
+        self.assertEqual(reports, parallel.audit_parallel(workers=2))
+        self.assertEqual(serial.error_details_report(), parallel.error_details_report())
+        incremental = easyrider.EzRider(records, schema=schema, error_samples=2)
+        self.assertEqual(reports, incremental.start_incremental())
+        self.assertEqual(4, incremental.error_details_report()["zone.type"]["count"])
+
+    def test_validator_memo(self):
+        """ memoized format checks give the same errors, stay within their size and count hits and misses"""
+        for user_input in ALL_INPUTS:
+            plain = easyrider.EzRider(user_input)
+            plain.total_report_errors_found()
+            memoized = easyrider.EzRider(user_input, memo_size=5)
+            memoized.total_report_errors_found()
+            self.assertEqual(plain.total_errors_dict, memoized.total_errors_dict)
+
+        ezrider = easyrider.EzRider([], memo_size=3)
+        ezrider.validator_memo.clear()
+        for _ in range(2):
+            for stop_name in ["Elm Street", "elm street", "Abbey Road", "Sesame Street"]:
+                ezrider.check_data_types("stop_name", stop_name)
+        self.assertFalse(ezrider.check_data_types("stop_name", ["Elm Street"]))
+        self.assertEqual({"hits": 0, "misses": 8, "size": 3}, ezrider.validator_memo.stats()["stop_name"])
+        self.assertTrue(ezrider.check_data_types("stop_name", "Sesame Street"))
+        self.assertEqual(1, ezrider.validator_memo.stats()["stop_name"]["hits"])
+
+        records = json.loads(stage_six_input) * 50
+        ezrider = easyrider.EzRider(records, memo_size=64)
+        ezrider.audit_parallel(workers=2)
+        memo_stats = ezrider.worker_memo_stats["a_time"]
+        self.assertEqual(len(records), memo_stats["hits"] + memo_stats["misses"])
+        self.assertGreater(memo_stats["hits"], memo_stats["misses"])
+
+    def test_timetable(self):
+        """ next departures and calling lines at a stop, by binary search over its sorted calls"""
+        timetable = easyrider.EzRider(io.StringIO(stage_six_input)).timetable()
+        self.assertEqual([("08:19", 128), ("09:45", 256)], timetable.next_departures("Elm Street", "08:15"))
+        self.assertEqual([("09:45", 256)], timetable.next_departures("Elm Street", 8 * 60 + 20))
+        self.assertEqual([("08:19", 128)], timetable.next_departures("Elm Street", "08:15", limit=1))
+        # buses end their line at Sesame Street
+        self.assertEqual([], timetable.next_departures("Sesame Street", "00:00"))
+        self.assertEqual([("08:37", 128), ("10:12", 256)], timetable.calls_between("Sesame Street", "08:00", "11:00"))
+        self.assertEqual([256, 512], timetable.lines_at_stop("Sunset Boulevard"))
+        self.assertEqual([512], timetable.lines_at_stop("Sunset Boulevard", "08:00", "09:00"))
+        self.assertEqual([], timetable.lines_at_stop("Abbey Road", "08:00", "09:00"))
+        self.assertEqual(7, len(timetable))
+
+    def test_journey_planner(self):
+        """ earliest arrival journeys, changing buses only at transfer stops"""
+        planner = easyrider.EzRider(stage_six_input).journey_planner()
+        self.assertEqual(7, len(planner))
+        self.assertEqual([easyrider.JourneyLeg(128, "Prospekt Avenue", "08:12", "Elm Street", "08:19"),
+                          easyrider.JourneyLeg(256, "Elm Street", "09:45", "Sunset Boulevard", "09:59")],
+                         planner.earliest_arrival("Prospekt Avenue", "Sunset Boulevard", "08:00"))
+        self.assertEqual([easyrider.JourneyLeg(512, "Bourbon Street", "08:13", "Sunset Boulevard", "08:16")],
+                         planner.earliest_arrival("Bourbon Street", "Sunset Boulevard", "08:13"))
+        self.assertIsNone(planner.earliest_arrival("Prospekt Avenue", "Sunset Boulevard", "08:13"))
+        self.assertIsNone(planner.earliest_arrival("Fifth Avenue", "Sunset Boulevard", "08:00"))
+        self.assertEqual([], planner.earliest_arrival("Elm Street", "Elm Street", "08:00"))
+
+        # line 2 leaves Bay Road right after line 1 gets there, but Bay Road is not a transfer stop
+        connections = [(480, 490, "Ash Road", "Bay Road", 1), (490, 500, "Bay Road", "Cod Road", 1),
+                       (492, 495, "Bay Road", "Dew Road", 2), (505, 515, "Cod Road", "Dew Road", 3)]
+        planner = easyrider.JourneyPlanner(connections, ["Cod Road"])
+        self.assertEqual([(1, "Ash Road", "Cod Road"), (3, "Cod Road", "Dew Road")],
+                         [(leg.bus_id, leg.board_stop, leg.alight_stop)
+                          for leg in planner.earliest_arrival("Ash Road", "Dew Road", "08:00")])
+        planner = easyrider.JourneyPlanner(connections, ["Bay Road", "Cod Road"])
+        self.assertEqual("08:15", planner.earliest_arrival("Ash Road", "Dew Road", "08:00")[-1].arrival)
+        planner = easyrider.JourneyPlanner(connections, ["Bay Road", "Cod Road"], transfer_minutes=5)
+        self.assertEqual("08:35", planner.earliest_arrival("Ash Road", "Dew Road", "08:00")[-1].arrival)
+
+        # line 1 reaches line 2 at the Elm Road transfer, before line 2 passes the origin
+        connections = [(490, 495, "Oak Road", "Elm Road", 1), (500, 518, "Elm Road", "Fir Road", 2),
+                       (518, 525, "Fir Road", "Oak Road", 2), (525, 530, "Oak Road", "Yew Road", 2)]
+        planner = easyrider.JourneyPlanner(connections, ["Elm Road"])
+        self.assertEqual([easyrider.JourneyLeg(1, "Oak Road", "08:10", "Elm Road", "08:15"),
+                          easyrider.JourneyLeg(2, "Elm Road", "08:20", "Fir Road", "08:38")],
+                         planner.earliest_arrival("Oak Road", "Fir Road", "08:00"))
+
+        # the line goes back in time after Bourbon Street, so it is cut there and never ridden backwards
+        records = [{"bus_id": 1, "stop_id": 1, "stop_name": "Abbey Road", "next_stop": 2, "stop_type": "S",
+                    "a_time": "09:00"},
+                   {"bus_id": 1, "stop_id": 2, "stop_name": "Bourbon Street", "next_stop": 3, "stop_type": "",
+                    "a_time": "09:10"},
+                   {"bus_id": 1, "stop_id": 3, "stop_name": "Chase Street", "next_stop": 4, "stop_type": "",
+                    "a_time": "08:00"},
+                   {"bus_id": 1, "stop_id": 4, "stop_name": "Dover Street", "next_stop": 0, "stop_type": "F",
+                    "a_time": "08:30"}]
+        planner = easyrider.EzRider(records).journey_planner()
+        self.assertIsNone(planner.earliest_arrival("Chase Street", "Bourbon Street", "07:00"))
+        self.assertIsNone(planner.earliest_arrival("Abbey Road", "Dover Street", "07:00"))
+        self.assertEqual([easyrider.JourneyLeg(1, "Chase Street", "08:00", "Dover Street", "08:30")],
+                         planner.earliest_arrival("Chase Street", "Dover Street", "07:00"))
+        self.assertEqual([easyrider.JourneyLeg(1, "Abbey Road", "09:00", "Bourbon Street", "09:10")],
+                         planner.earliest_arrival("Abbey Road", "Bourbon Street", "07:00"))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "the resident validator forks its workers")
+    def test_fork_server(self):
+        """ a resident validator answers the feeds a client sends it, from forked workers"""
+        with tempfile.TemporaryDirectory() as directory:
+            for file_name, feed in {"good.json": STAGE_FOUR_INPUT, "broken.json": "[{",
+                                    "values.json": '[["a"], "x"]'}.items():
+                with open(os.path.join(directory, file_name), "w") as feed_file:
+                    feed_file.write(feed)
+            socket_path = os.path.join(directory, "easyrider.sock")
+            server = easyrider.ForkServer(socket_path).start()
+            server_pid = os.fork()
+            if server_pid == 0:
+                try:
+                    server.serve_forever()
+                finally:
+                    os._exit(0)
+            server.listener.close()
+            try:
+                for _ in range(2):
+                    results = list(easyrider_client.request_validation(socket_path, [directory], ["stage_four"]))
+                    self.assertEqual(4, len(results))
+                    by_name = {os.path.basename(result["path"]): result for result in results[:-1]}
+                    self.assertEqual({"stage_four": STAGE_FOUR_OUTPUT}, by_name["good.json"]["reports"])
+                    self.assertIn("JSONDecodeError", by_name["broken.json"]["error"])
+                    self.assertIn("AttributeError", by_name["values.json"]["error"])
+                    self.assertEqual({"feeds": 3, "failed": 2}, {name: results[-1]["server"][name]
+                                                                 for name in ("feeds", "failed")})
+                    self.assertGreaterEqual(results[-1]["server"]["fork_seconds"], 0)
+                results = list(easyrider_client.request_validation(socket_path, [directory], ["stage_seven"]))
+                self.assertEqual([{"error": "ValueError: unknown stages: stage_seven"}], results)
+            finally:
+                os.kill(server_pid, signal.SIGTERM)
+                os.waitpid(server_pid, 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
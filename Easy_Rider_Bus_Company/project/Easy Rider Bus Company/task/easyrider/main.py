@@ -13,10 +13,32 @@ This project helps to plunge into the real reality. A good workout before work.
 from dataclasses import dataclass, field
 import json
 from collections import Counter, defaultdict
-import inspect
-import time
+from collections.abc import Mapping
 import re
-import itertools
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import bisect
+import csv
+import functools
+import gc
+import hashlib
+import io
+import heapq
+import mmap
+import operator
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the columnar store
+    np = None
 
 
 class BadBusException(Exception):
@@ -26,91 +48,972 @@ class BadBusException(Exception):
 class FormatError(Exception):
     pass
 
+# formats of the stop_name and a_time fields, compiled once
+STOP_NAME_TEMPLATE = re.compile(r"((([A-Z][a-z]*) )+(Boulevard|Street|Avenue|Road))$")
+A_TIME_TEMPLATE = re.compile(r"(2[0-3]|[01]\d):[0-5]\d")  # HH:MM, as accepted by time.strptime
+
+# the stages in the order they are reported
+STAGES = ("stage_one", "stage_two", "stage_three", "stage_four", "stage_five", "stage_six")
+
+# the EzRider methods timed by its profiler
+PROFILED_METHODS = ("line_topology_index", "route_graph_index", "total_report_errors_found", "stops_counter",
+                    "get_buses_with_starts_finals", "unqiue_start_final_stops", "find_transfer_stops",
+                    "stops_sepcifier", "stops_time_validation", "timing_statistics", "validate_on_demand_stops",
+                    "audit", "audit_parallel", "start_incremental", "apply_changes")
+
+
+@dataclass(frozen=True)
+class SchemaField:
+    """ the declared type, format and requirement of a record field"""
+    name: str
+    type: type = str  # the exact type of the value
+    required: bool = False  # the value must not be ""
+    format: str = None  # a regular expression the value must match
+    match: str = "fullmatch"  # how format is matched, "fullmatch" or "match" (for formats anchored with $)
+    values: frozenset = None  # the only values allowed
+
+    def config(self) -> dict:
+        return {"name": self.name, "type": self.type.__name__, "required": self.required, "format": self.format,
+                "match": self.match, "values": None if self.values is None else sorted(self.values)}
+
+
+# the fields of a record, as the bus company documents them
+DEFAULT_SCHEMA = (SchemaField("bus_id", int, required=True),
+                  SchemaField("stop_id", int, required=True),
+                  SchemaField("stop_name", str, required=True, format=STOP_NAME_TEMPLATE.pattern, match="match"),
+                  SchemaField("next_stop", int, required=True),
+                  SchemaField("stop_type", str, values=frozenset(["", "S", "O", "F", " "])),
+                  SchemaField("a_time", str, required=True, format=A_TIME_TEMPLATE.pattern))
+
+def schema_validator(schema_field):
+    """ the type and format check of a single field, as the entries of EzRider.dtypes_list"""
+    field_type = schema_field.type
+    matcher = getattr(re.compile(schema_field.format), schema_field.match) if schema_field.format else None
+    values = schema_field.values
+
+    def validator(x):
+        return (type(x) == field_type and (matcher is None or matcher(x) is not None)
+                and (values is None or x in values))
+    validator.__name__ = validator.__qualname__ = f"_{schema_field.name}"
+    return validator
+
+class ValidatorMemo:
+    """ bounded LRU memo of the results of the format checks, by field and value.
+    feeds repeat the same stop names and times over and over, so most checks become a lookup. only fields with a
+    format are memoized, a type or membership check costs less than the lookup. values that can not be hashed
+    are checked without the memo"""
+
+    def __init__(self, schema, max_size=4096):
+        self.max_size = max_size
+        self.memos = {}  # field -> lru_cache of its validator
+        self.validators = {}  # field -> memoized validator
+        for schema_field in schema:
+            if schema_field.format:
+                self.add_validator(schema_field.name, schema_validator(schema_field))
+
+    def add_validator(self, inp_field, validator):
+        # typed, so True and 1.0 are not taken for the int 1
+        memo = functools.lru_cache(maxsize=self.max_size, typed=True)(validator)
+
+        @functools.wraps(validator)
+        def memoized(x):
+            try:
+                return memo(x)
+            except TypeError:
+                return validator(x)
+        self.memos[inp_field] = memo
+        self.validators[inp_field] = memoized
+
+    def stats(self) -> dict:
+        """ hits, misses and size of the memo of every field"""
+        stats = {}
+        for inp_field, memo in self.memos.items():
+            info = memo.cache_info()
+            stats[inp_field] = {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+        return stats
+
+    def clear(self):
+        for memo in self.memos.values():
+            memo.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def shared_validator_memo(schema, max_size):
+    """ the memo of a schema, shared by every EzRider of the process (and so by the shards a worker audits)"""
+    return ValidatorMemo(schema, max_size)
+
+@functools.lru_cache(maxsize=None)
+def compile_schema(schema, memo_size=0):
+    """ generate the record checker of a schema (a tuple of SchemaField).
+    the checker takes a record and returns a bit mask of its errors, bit i for a wrong type or format of the
+    i-th field and bit len(schema) + i for an empty required field, 0 for a valid record. it returns None for a
+    record that does not have exactly the fields of the schema, those are left to the checks field by field.
+    with memo_size, the formats are checked through shared_validator_memo"""
+    memo = shared_validator_memo(schema, memo_size) if memo_size else None
+    field_names = [schema_field.name for schema_field in schema]
+    namespace = {"_values": operator.itemgetter(*field_names)}
+    names = ", ".join(f"v{position}" for position in range(len(schema))) + ("," if len(schema) == 1 else "")
+    lines = ["def check_record(record):"]
+    indent = "    "
+    if set(field_names) == STOP_RECORD_FIELDS:
+        # read the slots of a StopRecord directly, its Mapping methods run in Python
+        namespace.update(_StopRecord=StopRecord, _attributes=operator.attrgetter(*field_names))
+        lines += ["    if type(record) is _StopRecord:",
+                  f"        {names} = _attributes(record)",
+                  "    else:"]
+        indent = "        "
+    lines += [f"{indent}if len(record) != {len(schema)}:",
+              f"{indent}    return None",
+              f"{indent}try:",
+              f"{indent}    {names} = _values(record)",
+              f"{indent}except KeyError:",
+              f"{indent}    return None",
+              "    errors = 0"]
+    if memo is not None:
+        # a value that can not be hashed for the memo sends the record to the checks field by field
+        lines += ["    try:"]
+    for position, schema_field in enumerate(schema):
+        value = f"v{position}"
+        if memo is not None and schema_field.name in memo.memos:
+            # the memoized validator checks the type and the values as well
+            namespace[f"_valid{position}"] = memo.memos[schema_field.name]
+            conditions = [f"not _valid{position}({value})"]
+        else:
+            namespace[f"_type{position}"] = schema_field.type
+            conditions = [f"type({value}) is not _type{position}"]
+            if schema_field.format:
+                namespace[f"_format{position}"] = getattr(re.compile(schema_field.format), schema_field.match)
+                conditions.append(f"_format{position}({value}) is None")
+            if schema_field.values is not None:
+                namespace[f"_allowed{position}"] = frozenset(schema_field.values)
+                conditions.append(f"{value} not in _allowed{position}")
+        indent = "        " if memo is not None else "    "
+        lines += [f"{indent}if {' or '.join(conditions)}:",
+                  f"{indent}    errors |= {1 << position}"]
+        # a value of another type than str is never empty
+        if schema_field.required and schema_field.type is str:
+            lines += [f"{indent}elif {value} == '':",
+                      f"{indent}    errors |= {1 << (len(schema) + position)}"]
+    if memo is not None:
+        lines += ["    except TypeError:",
+                  "        return None"]
+    lines.append("    return errors")
+    exec(compile("\n".join(lines), "<schema checker>", "exec"), namespace)
+    return namespace["check_record"]
+
+class StopRecord(Mapping):
+    """ a compact, read-only stop record with a slot per field instead of a dict.
+    it is also a mapping, so it can be used wherever a record dict is"""
+    __slots__ = ("bus_id", "stop_id", "stop_name", "next_stop", "stop_type", "a_time")
+
+    def __init__(self, bus_id, stop_id, stop_name, next_stop, stop_type, a_time):
+        self.bus_id = bus_id
+        self.stop_id = stop_id
+        self.stop_name = stop_name
+        self.next_stop = next_stop
+        self.stop_type = stop_type
+        self.a_time = a_time
+
+    def __getitem__(self, key):
+        if key not in STOP_RECORD_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def items(self):
+        return zip(self.__slots__, (self.bus_id, self.stop_id, self.stop_name,
+                                    self.next_stop, self.stop_type, self.a_time))
+
+    def __reduce__(self):
+        return StopRecord, (self.bus_id, self.stop_id, self.stop_name, self.next_stop, self.stop_type, self.a_time)
+
+    def __repr__(self):
+        return f"StopRecord({dict(self.items())})"
+
+STOP_RECORD_FIELDS = frozenset(StopRecord.__slots__)
+# the values of a record in slot order, read straight from the slots of a StopRecord or by key from a dict.
+# the hot loops read StopRecord slots directly, its Mapping methods run in Python
+STOP_RECORD_VALUES = operator.attrgetter(*StopRecord.__slots__)
+RECORD_VALUES = operator.itemgetter(*StopRecord.__slots__)
+
+def stop_record_hook(json_object, shared_ints=None):
+    """ json object_hook building a StopRecord from every object that has exactly the record fields.
+    the strings that repeat across records are interned, so every record shares a single copy.
+    with shared_ints, a dict kept for one document, the ids that repeat share a single int as well"""
+    if json_object.keys() != STOP_RECORD_FIELDS:
+        return json_object
+    bus_id, stop_id, next_stop = json_object["bus_id"], json_object["stop_id"], json_object["next_stop"]
+    if shared_ints is not None:
+        # a line repeats its bus_id, and every next_stop is the stop_id of another record
+        bus_id = shared_ints.setdefault(bus_id, bus_id) if type(bus_id) == int else bus_id
+        stop_id = shared_ints.setdefault(stop_id, stop_id) if type(stop_id) == int else stop_id
+        next_stop = shared_ints.setdefault(next_stop, next_stop) if type(next_stop) == int else next_stop
+    stop_name, stop_type, a_time = json_object["stop_name"], json_object["stop_type"], json_object["a_time"]
+    return StopRecord(bus_id, stop_id,
+                      sys.intern(stop_name) if type(stop_name) == str else stop_name,
+                      next_stop,
+                      sys.intern(stop_type) if type(stop_type) == str else stop_type,
+                      sys.intern(a_time) if type(a_time) == str else a_time)
+
+
+class JsonArrayDecoder:
+    """ incremental decoder of a top-level JSON array.
+    feed it the text as it arrives and get back the records completed so far"""
+    # a failed token followed by one of these can not be completed by more text
+    token_end = re.compile(r"[\s,:\]}]")
+
+    def __init__(self, object_hook=None):
+        self.decoder = json.JSONDecoder(object_hook=object_hook)
+        self.buffer = ""
+        self.state = "start"  # start -> first -> item <-> separator -> done
+
+    def feed(self, text, final=False) -> list:
+        """ the records completed by text. final marks the end of the input"""
+        buffer = self.buffer + text
+        records = []
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos == len(buffer):
+                break
+            if self.state == "start":
+                if buffer[pos] != "[":
+                    raise json.JSONDecodeError("Expecting '['", buffer, pos)
+                pos += 1
+                self.state = "first"
+            elif self.state == "first" and buffer[pos] == "]":
+                pos += 1
+                self.state = "done"
+            elif self.state in ("first", "item"):
+                try:
+                    record, end = self.decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as error:
+                    if final or not self.incomplete(error, buffer):
+                        raise
+                    break  # the record continues in the next piece of text
+                if end == len(buffer) and not final:
+                    break  # a number may continue in the next piece of text
+                records.append(record)
+                pos = end
+                self.state = "separator"
+            elif self.state == "separator":
+                if buffer[pos] == "]":
+                    self.state = "done"
+                elif buffer[pos] == ",":
+                    self.state = "item"
+                else:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                pos += 1
+            else:
+                raise json.JSONDecodeError("Extra data", buffer, pos)
+        # keep only what was not decoded yet
+        self.buffer = buffer[pos:]
+        if final and self.state != "done":
+            raise json.JSONDecodeError("Expecting ']'", buffer, pos)
+        return records
+
+    def incomplete(self, error, buffer) -> bool:
+        """ did decoding fail only because the buffer ends inside a record.
+        a malformed record is reported at once instead of buffering the rest of the input"""
+        if error.msg.startswith("Unterminated string"):
+            # strings can not hold raw control characters, so an unclosed one runs to the end of the buffer
+            return True
+        return self.token_end.search(buffer, error.pos) is None
+
+
+def iter_json_records(stream, chunk_size=65536, object_hook=None):
+    """ yield the items of a top-level JSON array read from a text stream, one at a time.
+    only the record currently being decoded is kept in memory"""
+    decoder = JsonArrayDecoder(object_hook)
+    while True:
+        chunk = stream.read(chunk_size)
+        yield from decoder.feed(chunk, final=not chunk)
+        if not chunk:
+            return
+
+
+class Profiler:
+    """ call counts, cumulative wall time and throughput of the validators and stage methods of an EzRider"""
+
+    def __init__(self):
+        self.stats = {}  # name -> {"calls": .., "seconds": .., "records": ..}
+
+    def record(self, name, seconds, records=1):
+        stat = self.stats.setdefault(name, {"calls": 0, "seconds": 0.0, "records": 0})
+        stat["calls"] += 1
+        stat["seconds"] += seconds
+        stat["records"] += records
+
+    def timed(self, name, function, count_records=None):
+        """ wrap function so every call is recorded under name"""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start, count_records() if count_records else 1)
+        return wrapper
+
+    def timed_records(self, name, records):
+        """ wrap an iterator of records, recording the time spent producing each of them"""
+        iterator = iter(records)
+        while True:
+            start = time.perf_counter()
+            try:
+                data_point = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield data_point
+
+    def report(self) -> dict:
+        """ the stats of every name, with records per second"""
+        report = {}
+        for name, stat in self.stats.items():
+            records_per_second = stat["records"] / stat["seconds"] if stat["seconds"] else None
+            report[name] = dict(stat, records_per_second=records_per_second)
+        return report
+
+    def dump(self, stream):
+        """ write the report as JSON"""
+        json.dump(self.report(), stream, indent=2)
+
+
+@dataclass
+class LineTopology:
+    """ the route of one bus line, as read from its records"""
+    bus_id: int
+    first_index: int  # index of the first record of the line
+    stop_ids: list = field(default_factory=list)  # in record order
+    stop_names: list = field(default_factory=list)
+    stop_types: list = field(default_factory=list)
+    next_stops: list = field(default_factory=list)
+    a_times: list = field(default_factory=list)
+    start_indexes: list = field(default_factory=list)  # indexes of the records of its start stops
+    final_indexes: list = field(default_factory=list)
+    start_stop: str = None
+    final_stop: str = None
+    route_fault: tuple = None  # (index, record) of the first record that can not be mapped on a route
+
+
+@dataclass
+class LineRoute:
+    """ the stops of a bus line chained by their stop_id -> next_stop links"""
+    bus_id: int
+    order: list  # positions of the line's records in route order, stops off the route last
+    dangling: list  # (stop_id, next_stop) links to a stop that is not on the line
+    orphans: list  # stop ids that can not be reached from the first stop
+    cycle: bool  # following the links comes back to a stop
+    broken: bool  # the links do not form a single chain
+
+    @property
+    def is_valid(self):
+        return not (self.dangling or self.orphans or self.cycle or self.broken)
+
+    @classmethod
+    def from_topology(cls, line):
+        """ follow the links of a line, in time linear in its number of stops"""
+        positions = {}  # stop_id -> position of its record in the line
+        broken = False
+        for position, stop_id in enumerate(line.stop_ids):
+            if stop_id in positions:
+                broken = True  # the same stop twice
+            else:
+                positions[stop_id] = position
+
+        dangling = []
+        incoming = Counter()
+        for position, next_stop in enumerate(line.next_stops):
+            if next_stop == 0:  # the last stop
+                continue
+            if next_stop not in positions:
+                dangling.append((line.stop_ids[position], next_stop))
+                continue
+            incoming[next_stop] += 1
+        heads = [position for stop_id, position in positions.items() if not incoming[stop_id]]
+        if len(heads) > 1 or any(count > 1 for count in incoming.values()):
+            broken = True
+
+        # start from the stop nothing links to, preferably the start stop
+        start_heads = [position for position in heads if line.stop_types[position] == "S"]
+        if start_heads or heads:
+            position = (start_heads or heads)[0]
+        else:
+            position = line.stop_types.index("S") if "S" in line.stop_types else 0
+        cycle = not heads
+
+        order = []
+        visited = set()
+        while True:
+            order.append(position)
+            visited.add(position)
+            next_stop = line.next_stops[position]
+            if next_stop == 0 or next_stop not in positions:
+                break
+            position = positions[next_stop]
+            if position in visited:
+                cycle = True
+                break
+        orphans = [line.stop_ids[position] for position in range(len(line.stop_ids)) if position not in visited]
+        order += [position for position in range(len(line.stop_ids)) if position not in visited]
+        return cls(line.bus_id, order, dangling, orphans, cycle, broken)
+
+
+class TravelTimeSketch:
+    """ mergeable distribution of travel times in whole minutes.
+    times are kept as counts per minute, so the quantiles are exact and the size is bounded by the
+    minutes of a day however many times are added"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+
+    def add(self, minutes, count=1):
+        self.counts[minutes] += count
+        self.count += count
+
+    def merge(self, other):
+        """ add the times of another sketch, e.g. of another shard"""
+        self.counts.update(other.counts)
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """ the smallest time with at least a q share of the times at or below it"""
+        if not self.count:
+            return None
+        rank = max(1, -(-q * self.count // 1))  # ceil(q * count)
+        seen = 0
+        for minutes in sorted(self.counts):
+            seen += self.counts[minutes]
+            if seen >= rank:
+                return minutes
+
+    def summary(self) -> dict:
+        return {"count": self.count,
+                "min": min(self.counts) if self.count else None,
+                "median": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99),
+                "max": max(self.counts) if self.count else None}
+
+
+class TimingStatistics:
+    """ travel times between consecutive stops, per line and per segment, and the end to end duration of
+    every line, collected in one pass over the records. statistics of shards holding whole lines can be merged"""
+
+    def __init__(self):
+        self.line_sketches = defaultdict(TravelTimeSketch)  # bus_id -> times between its consecutive stops
+        self.segment_sketches = defaultdict(TravelTimeSketch)  # (stop_name, next stop_name) -> times
+        self.line_durations = {}  # bus_id -> minutes from its first to its last stop
+        self.duration_sketch = TravelTimeSketch()  # of line_durations
+        self.last_stops = {}  # bus_id -> (stop_name, minutes) of the last stop seen
+
+    def add_stop(self, bus_id, stop_name, minutes):
+        if bus_id not in self.last_stops:
+            self.line_durations[bus_id] = 0
+        else:
+            last_stop_name, last_minutes = self.last_stops[bus_id]
+            travel_time = minutes - last_minutes
+            self.line_sketches[bus_id].add(travel_time)
+            self.segment_sketches[(last_stop_name, stop_name)].add(travel_time)
+            self.line_durations[bus_id] += travel_time
+        self.last_stops[bus_id] = (stop_name, minutes)
+
+    def finish(self):
+        self.duration_sketch = TravelTimeSketch()
+        for duration in self.line_durations.values():
+            self.duration_sketch.add(duration)
+        return self
+
+    def merge(self, other):
+        for bus_id, sketch in other.line_sketches.items():
+            self.line_sketches[bus_id].merge(sketch)
+        for segment, sketch in other.segment_sketches.items():
+            self.segment_sketches[segment].merge(sketch)
+        self.line_durations.update(other.line_durations)
+        self.last_stops.update(other.last_stops)
+        return self.finish()
+
+    def all_segments_sketch(self):
+        sketch = TravelTimeSketch()
+        for segment_sketch in self.segment_sketches.values():
+            sketch.merge(segment_sketch)
+        return sketch
+
+
+def sample_priority(index):
+    """ a pseudo random 64 bit number fixed by the record index, the same in every process"""
+    x = (hash(index) + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+class ErrorDetail:
+    """ where one kind of error was found in one field: the exact count, the indexes of the first records with
+    the error and a uniform sample of (index, value) pairs, all in bounded memory.
+    the sample keeps the records with the smallest sample_priority, so merging the details of shards gives the
+    sample a single pass over the whole feed would have kept"""
+
+    def __init__(self, sample_size=10, first_size=10):
+        self.sample_size = sample_size
+        self.first_size = first_size
+        self.count = 0
+        self.first_indexes = []  # sorted
+        self.sample = []  # heap of (-priority, index, value), the largest priority on top
+
+    def add(self, index, value):
+        self.count += 1
+        if len(self.first_indexes) < self.first_size:
+            bisect.insort(self.first_indexes, index)
+        elif self.first_indexes and index < self.first_indexes[-1]:
+            bisect.insort(self.first_indexes, index)
+            self.first_indexes.pop()
+
+        priority = sample_priority(index)
+        if len(self.sample) < self.sample_size:
+            heapq.heappush(self.sample, (-priority, index, value))
+        elif self.sample and priority < -self.sample[0][0]:
+            heapq.heapreplace(self.sample, (-priority, index, value))
+
+    def merge(self, other):
+        """ add the errors of another detail, e.g. of another shard"""
+        self.count += other.count
+        self.first_indexes = heapq.nsmallest(self.first_size, self.first_indexes + other.first_indexes)
+        self.sample = heapq.nsmallest(self.sample_size, self.sample + other.sample, key=lambda entry: -entry[0])
+        heapq.heapify(self.sample)
+        return self
+
+    def summary(self) -> dict:
+        return {"count": self.count,
+                "first_indexes": list(self.first_indexes),
+                "sample": sorted((index, value) for _, index, value in self.sample)}
+
+
+class StopDirectory:
+    """ read-only directory of the stops of a validated feed: whether a stop is a start, transfer or finish stop,
+    and which lines serve it. every lookup is a single hash lookup"""
+    __slots__ = ("_classes", "_lines")
+
+    def __init__(self, stops_sepcifier_report, stop_lines):
+        classes = defaultdict(set)
+        for stop_type, stop_names in stops_sepcifier_report.items():
+            for stop_name in stop_names:
+                classes[stop_name].add(stop_type)
+        self._classes = {stop_name: frozenset(stop_types) for stop_name, stop_types in classes.items()}
+        self._lines = {stop_name: frozenset(bus_ids) for stop_name, bus_ids in stop_lines.items()}
+
+    def classification(self, stop_name) -> frozenset:
+        """ which of "S", "T" and "F" the stop is"""
+        return self._classes.get(stop_name, frozenset())
+
+    def is_start(self, stop_name) -> bool:
+        return "S" in self._classes.get(stop_name, ())
+
+    def is_transfer(self, stop_name) -> bool:
+        return "T" in self._classes.get(stop_name, ())
+
+    def is_finish(self, stop_name) -> bool:
+        return "F" in self._classes.get(stop_name, ())
+
+    def is_route_stop(self, stop_name) -> bool:
+        """ is the stop a start, transfer or finish stop"""
+        return stop_name in self._classes
+
+    def lines_serving(self, stop_name) -> frozenset:
+        return self._lines.get(stop_name, frozenset())
+
+    def __contains__(self, stop_name):
+        return stop_name in self._lines
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+
+def time_minutes(a_time) -> int:
+    """ minutes since midnight of a HH:MM time, minutes are returned as they are"""
+    if type(a_time) == int:
+        return a_time
+    return int(a_time[:2]) * 60 + int(a_time[3:])
+
+def minutes_time(minutes) -> str:
+    """ the HH:MM time of minutes since midnight"""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class Timetable:
+    """ the calls of the lines at every stop, sorted by time, for lookups by binary search.
+    times are given as HH:MM or as minutes since midnight, and returned as HH:MM"""
+    __slots__ = ("_times", "_bus_ids", "_departs")
+
+    def __init__(self, calls):
+        """ calls maps a stop name to its (minutes, bus_id, departs) calls, in any order"""
+        self._times = {}  # stop_name -> array of the minutes of its calls, sorted
+        self._bus_ids = {}  # stop_name -> the bus_id of every call
+        self._departs = {}  # stop_name -> whether the bus leaves the stop, it does not at its final stop
+        for stop_name, stop_calls in calls.items():
+            stop_calls.sort()
+            self._times[stop_name] = array("H", [minutes for minutes, _, _ in stop_calls])
+            self._bus_ids[stop_name] = [bus_id for _, bus_id, _ in stop_calls]
+            self._departs[stop_name] = bytes(departs for _, _, departs in stop_calls)
+
+    @classmethod
+    def from_records(cls, records, ezrider):
+        """ index the records with a valid bus_id, stop_name and a_time in a single pass"""
+        calls = defaultdict(list)
+        for data_point in records:
+            bus_id = data_point["bus_id"]
+            stop_name = data_point["stop_name"]
+            a_time = data_point["a_time"]
+            if not (ezrider.check_data_types("bus_id", bus_id) and ezrider.check_data_types("stop_name", stop_name)
+                    and ezrider.check_data_types("a_time", a_time)):
+                continue
+            calls[stop_name].append((time_minutes(a_time), bus_id, data_point["stop_type"] != "F"))
+        return cls(calls)
+
+    def next_departures(self, stop_name, after, limit=5) -> list:
+        """ the (HH:MM, bus_id) of the first limit departures from the stop at or after a time"""
+        times = self._times.get(stop_name)
+        if times is None:
+            return []
+        bus_ids = self._bus_ids[stop_name]
+        departs = self._departs[stop_name]
+        departures = []
+        for position in range(bisect.bisect_left(times, time_minutes(after)), len(times)):
+            if departs[position]:
+                departures.append((minutes_time(times[position]), bus_ids[position]))
+                if len(departures) == limit:
+                    break
+        return departures
+
+    def calls_between(self, stop_name, start, end) -> list:
+        """ the (HH:MM, bus_id) of the calls at the stop from start to end, both included"""
+        times = self._times.get(stop_name)
+        if times is None:
+            return []
+        first = bisect.bisect_left(times, time_minutes(start))
+        last = bisect.bisect_right(times, time_minutes(end))
+        bus_ids = self._bus_ids[stop_name]
+        return [(minutes_time(times[position]), bus_ids[position]) for position in range(first, last)]
+
+    def lines_at_stop(self, stop_name, start="00:00", end="23:59") -> list:
+        """ the bus_ids of the lines calling at the stop from start to end, both included"""
+        times = self._times.get(stop_name)
+        if times is None:
+            return []
+        first = bisect.bisect_left(times, time_minutes(start))
+        last = bisect.bisect_right(times, time_minutes(end))
+        return sorted(set(self._bus_ids[stop_name][first:last]))
+
+    def __contains__(self, stop_name):
+        return stop_name in self._times
+
+    def __iter__(self):
+        return iter(self._times)
+
+    def __len__(self):
+        return len(self._times)
+
+
+@dataclass
+class JourneyLeg:
+    """ a ride on one bus line, from boarding to getting off"""
+    bus_id: int
+    board_stop: str
+    departure: str  # HH:MM
+    alight_stop: str
+    arrival: str
+
+
+class JourneyPlanner:
+    """ earliest arrival journeys by connection scan, over the rides between consecutive stops of every line.
+    the connections are sorted by departure once. buses can only be changed at the transfer stops, so a query
+    boards the buses leaving its origin, and then scans only the connections leaving transfer stops from its
+    departure time on, until one leaves after the best arrival found. a boarded bus is followed along its line,
+    and followed again from an earlier stop when a transfer reaches it there"""
+
+    def __init__(self, connections, transfer_stops, transfer_minutes=0):
+        """ connections are (departure, arrival, from stop_name, to stop_name, bus_id[, trip]), times in minutes.
+        a trip is one run of a bus along its line, its bus_id unless given. the connections of a trip are
+        listed in the order of its line, with times that never go back"""
+        trip_numbers = {}  # trip -> trip number, in the order the trips are first listed
+        route_positions = []  # the place of each listed connection in its trip
+        trip_lengths = []
+        self.trip_bus_ids = []
+        for connection in connections:
+            trip = trip_numbers.setdefault(connection[5] if len(connection) > 5 else connection[4], len(trip_numbers))
+            if trip == len(trip_lengths):
+                trip_lengths.append(0)
+                self.trip_bus_ids.append(connection[4])
+            route_positions.append(trip_lengths[trip])
+            trip_lengths[trip] += 1
+        trips = [trip_numbers[connection[5] if len(connection) > 5 else connection[4]] for connection in connections]
+        order = sorted(range(len(connections)), key=lambda listed: (connections[listed][0], connections[listed][1]))
+        connections = [connections[listed] for listed in order]
+
+        self.stop_names = sorted({stop_name for connection in connections for stop_name in connection[2:4]}
+                                 | set(transfer_stops))
+        self.stop_numbers = {stop_name: number for number, stop_name in enumerate(self.stop_names)}
+        self.departures = array("H", [connection[0] for connection in connections])
+        self.arrivals = array("H", [connection[1] for connection in connections])
+        self.from_stops = array("I", [self.stop_numbers[connection[2]] for connection in connections])
+        self.to_stops = array("I", [self.stop_numbers[connection[3]] for connection in connections])
+        self.trips = array("I", [trips[listed] for listed in order])
+        self.transfers = bytearray(len(self.stop_names))  # 1 for the stops where buses can be changed
+        for stop_name in transfer_stops:
+            self.transfers[self.stop_numbers[stop_name]] = 1
+        self.transfer_minutes = transfer_minutes
+
+        # the connections of every trip in the order of its line, and the place of each connection in its trip
+        self.trip_connections = [array("I", bytes(4 * length)) for length in trip_lengths]
+        self.trip_positions = array("I", [route_positions[listed] for listed in order])
+        self.stop_departures = defaultdict(lambda: array("I"))  # stop -> its connections, by departure
+        for number, trip in enumerate(self.trips):
+            self.trip_connections[trip][self.trip_positions[number]] = number
+            self.stop_departures[self.from_stops[number]].append(number)
+        self.stop_departures = dict(self.stop_departures)
+        self.transfer_connections = array("I", [number for number, from_stop in enumerate(self.from_stops)
+                                                if self.transfers[from_stop]])
+        self.transfer_departures = array("H", [self.departures[number] for number in self.transfer_connections])
+
+    @classmethod
+    def from_topology(cls, topology, transfer_stops, ezrider, transfer_minutes=0):
+        """ the connections between the consecutive stops of every line with valid arrival times"""
+        connections = []
+        for bus_id, line in topology.items():
+            trip = 0
+            for position in range(len(line.stop_names) - 1):
+                departure, arrival = line.a_times[position], line.a_times[position + 1]
+                if not (ezrider.check_data_types("a_time", departure) and ezrider.check_data_types("a_time", arrival)):
+                    trip += 1
+                    continue
+                departure, arrival = time_minutes(departure), time_minutes(arrival)
+                # a bus arriving before it left is an arrival time anomaly, not a ride.
+                # the line is cut there, so no journey rides past it
+                if arrival < departure:
+                    trip += 1
+                    continue
+                connections.append((departure, arrival, line.stop_names[position],
+                                    line.stop_names[position + 1], bus_id, (bus_id, trip)))
+        return cls(connections, transfer_stops, transfer_minutes)
+
+    def __len__(self):
+        return len(self.departures)
+
+    def earliest_arrival(self, origin, destination, departure):
+        """ the legs of the journey leaving origin at or after departure that reaches destination first.
+        an empty list when origin is the destination, None when the destination can not be reached"""
+        if origin == destination:
+            return []
+        if origin not in self.stop_numbers or destination not in self.stop_numbers:
+            return None
+        origin_number = self.stop_numbers[origin]
+        target = self.stop_numbers[destination]
+        departures, arrivals, from_stops, to_stops = self.departures, self.arrivals, self.from_stops, self.to_stops
+        leaves_at = time_minutes(departure)
+        earliest = [24 * 60] * len(self.stop_names)
+        earliest[origin_number] = leaves_at
+        boarded = {}  # trip -> the earliest position in its trip it was boarded at
+        reached_by = {}  # stop -> (boarding connection, arriving connection) of its earliest arrival
+
+        def ride(boarding):
+            """ follow the trip of a connection from there to the end of its line, or to where it was boarded before"""
+            trip = self.trips[boarding]
+            trip_connections = self.trip_connections[trip]
+            boarded_at = boarded.get(trip, len(trip_connections))
+            boarded[trip] = self.trip_positions[boarding]
+            for position in range(self.trip_positions[boarding], boarded_at):
+                number = trip_connections[position]
+                arrival = arrivals[number]
+                if arrival > earliest[target]:
+                    break
+                to_stop = to_stops[number]
+                if arrival < earliest[to_stop]:
+                    earliest[to_stop] = arrival
+                    reached_by[to_stop] = (boarding, number)
+
+        origin_departures = self.stop_departures.get(origin_number, ())
+        for position in range(bisect.bisect_left([departures[number] for number in origin_departures], leaves_at),
+                              len(origin_departures)):
+            boarding = origin_departures[position]
+            if self.trip_positions[boarding] < boarded.get(self.trips[boarding], len(self.departures)):
+                ride(boarding)
+
+        # buses can be changed once the first transfer stop is reached
+        reached_transfers = [earliest[stop] for stop in reached_by if self.transfers[stop]]
+        if self.transfers[origin_number]:
+            reached_transfers.append(leaves_at)
+        first_change = min(reached_transfers, default=None)
+        transfers, trips = self.transfer_connections, self.trips
+        transfer_minutes = self.transfer_minutes
+        scan_from = len(transfers) if first_change is None else bisect.bisect_left(self.transfer_departures,
+                                                                                 first_change + transfer_minutes)
+        for position in range(scan_from, len(transfers)):
+            boarding = transfers[position]
+            leaves = departures[boarding]
+            if leaves > earliest[target]:
+                break
+            if earliest[from_stops[boarding]] + transfer_minutes > leaves:
+                continue
+            # a trip reached further up its line than before is followed from there
+            if self.trip_positions[boarding] < boarded.get(trips[boarding], len(self.departures)):
+                ride(boarding)
+
+        if target not in reached_by:
+            return None
+        legs = []
+        stop = target
+        while stop != origin_number:
+            boarding, arriving = reached_by[stop]
+            legs.append(JourneyLeg(self.trip_bus_ids[self.trips[boarding]], self.stop_names[from_stops[boarding]],
+                                   minutes_time(departures[boarding]), self.stop_names[stop],
+                                   minutes_time(arrivals[arriving])))
+            stop = from_stops[boarding]
+        return legs[::-1]
+
+
 @dataclass
 class EzRider:
     """ class for sorting out the existing database of the "Easy Rider" bus company"""
-    user_input: str
+    user_input: str  # the JSON document, a text stream to read it from record by record, or a list of parsed records
+    chunk_size: int = 65536  # characters read at a time in streaming mode
+    profile: bool = False  # record the time spent in parsing, validators and stage methods in self.profiler
+    compact: bool = False  # decode the records as StopRecord objects instead of dicts - less memory, slower parse
+    schema: tuple = None  # SchemaField per record field, DEFAULT_SCHEMA when not given
+    memo_size: int = 0  # memoize the format checks of this many values per field, see ValidatorMemo
+    error_samples: int = 0  # keep this many sample records per field and error kind in self.error_details
+    first_errors: int = 10  # and the indexes of this many first records with the error, when error_samples is set
     #is_required: list = field(default_factory=lambda: ["bus_id", "stop_id", "stop_name", "next_stop", "a_time"])
 
-    def _one_char_check(self, x, allowed_chars="SOF "):
-        """ check is x is a single upper case letter"""
-        try:
-            is_string = type(x) == str
-            single_letter = len(x) <= 1
-            upper_case = x.upper() == x
-            allowed_char = x in allowed_chars
-            return is_string and single_letter and upper_case and allowed_char
-        except TypeError:
-            return False
+    def _int(self, x):
+        """ check is x is an integer"""
+        return type(x) == int
 
     def _atime(self, x):
         """ check is x is a HH:MM """
-        if type(x) != str:
-            return False
-        def is_hh_mm_time(time_string):
-            try:
-                time.strptime(time_string, '%H:%M')
-            except ValueError:
-                return False
-            return (len(time_string) == 5)
-
-        try:
-            return is_hh_mm_time(x)
-        except TypeError:
-            return False
-
+        return type(x) == str and A_TIME_TEMPLATE.fullmatch(x) is not None
 
     def _stop_name(self, x):
-        if type(x) != str: # check type
-            return False
-        template = re.compile(r"((([A-Z][a-z]*) )+(Boulevard|Street|Avenue|Road))$")
-        reg_match = re.match(template, x)
-        return bool(reg_match)
+        return type(x) == str and STOP_NAME_TEMPLATE.match(x) is not None
 
     def _stop_type(self, x):
-        # check datatype
-        if type(x) != str:
-            return False
-        # check formatd
-        if "stop_type" in self.is_required:
-            allowed_chars = "SOF"
-        else:
-            allowed_chars = "SOF "
-        match = self._one_char_check(x, allowed_chars)
-        return match
+        # check datatype and format - a single allowed upper case letter, or nothing
+        return type(x) == str and x in self.stop_type_values
 
     def __post_init__(self):
         """ initialize instance variables"""
+        self.schema = DEFAULT_SCHEMA if self.schema is None else tuple(self.schema)
+
         # all fields
-        self.fields = ["bus_id", "stop_id", "stop_name", "next_stop", "stop_type", "a_time"]
+        self.fields = [schema_field.name for schema_field in self.schema]
 
         # required fields to fill in
-        self.is_required = ["bus_id", "stop_id", "stop_name", "next_stop", "a_time"]
+        self.is_required = [schema_field.name for schema_field in self.schema if schema_field.required]
+
+        # the values accepted in stop_type
+        if "stop_type" in self.is_required:
+            self.stop_type_values = frozenset(["", "S", "O", "F"])
+        else:
+            self.stop_type_values = frozenset(["", "S", "O", "F", " "])
+
+        self.profiler = Profiler() if self.profile else None
+        self.line_topology = None  # bus_id -> LineTopology, see line_topology_index
+        self.line_routes = None  # bus_id -> LineRoute, see route_graph_index
+        self.stops_directory = None  # StopDirectory, once the stops are classified
 
         # pasring the input
-        self.parsed_input = json.loads(self.user_input)
+        object_hook = functools.partial(stop_record_hook, shared_ints={}) if self.compact else None
+        if isinstance(self.user_input, str):
+            start = time.perf_counter()
+            self.parsed_input = json.loads(self.user_input, object_hook=object_hook)
+            if self.profiler:
+                self.profiler.record("json_parse", time.perf_counter() - start, len(self.parsed_input))
+        elif isinstance(self.user_input, list):
+            self.parsed_input = self.user_input
+        else:
+            # streaming mode - records are decoded one at a time as they are consumed
+            self.parsed_input = iter_json_records(self.user_input, self.chunk_size, object_hook)
+            if self.profiler:
+                self.parsed_input = self.profiler.timed_records("json_parse", self.parsed_input)
+
+        # validator of the data type and format of each field
+        if self.schema == DEFAULT_SCHEMA:
+            self.dtypes_list = {"bus_id": self._int,
+                                "stop_id": self._int,
+                                "stop_name": self._stop_name,
+                                "next_stop": self._int,
+                                "stop_type": self._stop_type,
+                                "a_time": self._atime}
+        else:
+            self.dtypes_list = {schema_field.name: schema_validator(schema_field) for schema_field in self.schema}
 
-        # list of data types and formats
-        self.dtypes_list = {"bus_id": int,
-                            "stop_id": int,
-                            "stop_name": self._stop_name,
-                            "next_stop": int,
-                            "stop_type": self._stop_type,
-                            "a_time": self._atime}
+        # results of the format checks of repeated values, shared by the instances of this process
+        self.validator_memo = shared_validator_memo(self.schema, self.memo_size) if self.memo_size else None
+        if self.validator_memo is not None:
+            self.dtypes_list.update(self.validator_memo.validators)
+
+        # checker of whole records, see compile_schema
+        self.record_checker = compile_schema(self.schema, self.memo_size)
 
         # initialize dictionaries for keeping track of errors
         self.data_type_errors = dict.fromkeys(self.fields, 0)  # the error_counter dict
         self.error_counter = dict.fromkeys(self.fields, 0)  # the error_counter dict
+        self.error_details = {} if self.error_samples else None  # (field, "type" or "required") -> ErrorDetail
+
+        if self.profiler:
+            self.enable_profiling()
+
+    def enable_profiling(self):
+        """ time every validator and stage method of this instance.
+        the wrappers replace the table entries and methods, so nothing is added when profiling is off"""
+        if self.profiler is None:
+            self.profiler = Profiler()
+        self.dtypes_list = {inp_field: self.profiler.timed(checker.__name__, checker)
+                            for inp_field, checker in self.dtypes_list.items()}
+        # check records field by field, so every validator call is timed
+        self.record_checker = None
+
+        def count_records():
+            return len(self.parsed_input) if isinstance(self.parsed_input, list) else 0
+        for name in PROFILED_METHODS:
+            setattr(self, name, self.profiler.timed(name, getattr(self, name), count_records))
+        return self.profiler
+
+    def validator_config(self) -> dict:
+        """ everything that decides the outcome of the checks, besides the records"""
+        return {"fields": self.fields,
+                "is_required": self.is_required,
+                "dtypes_list": {inp_field: checker.__qualname__ for inp_field, checker in self.dtypes_list.items()},
+                "stop_name": STOP_NAME_TEMPLATE.pattern,
+                "a_time": A_TIME_TEMPLATE.pattern,
+                "stop_type": sorted(self.stop_type_values),
+                "schema": [schema_field.config() for schema_field in self.schema]}
+
+    def check_options(self) -> dict:
+        """ the options an EzRider checking part of the records of this one is made with"""
+        return {"schema": self.schema, "error_samples": self.error_samples, "first_errors": self.first_errors,
+                "memo_size": self.memo_size}
+
+    def materialize_input(self):
+        """ keep a streamed input in memory, for the checks that go over the records more than once"""
+        if not isinstance(self.parsed_input, list):
+            self.parsed_input = list(self.parsed_input)
+        return self.parsed_input
 
     def check_data_types(self, inp_field, inp_value) -> bool:
         """ return bool signaling if inp_value matches the required type"""
 
-        checker = self.dtypes_list[inp_field]
-        if inspect.ismethod(checker):
-            match = checker(inp_value)
-        else:
-            match = checker == type(inp_value)
-        return match
+        return self.dtypes_list[inp_field](inp_value)
 
     def check_if_filled(self, inp_field, inp_value) -> bool:
         empty = ""
@@ -118,26 +1021,63 @@ class EzRider:
             return False
         return True
 
+    def count_record_errors(self, data_point, index=None):
+        """ count the type and required field errors of a single record"""
+        if self.record_checker is not None:
+            errors = self.record_checker(data_point)
+            if errors == 0:
+                return
+            if errors is not None:
+                self.count_error_bits(errors, index, data_point)
+                return
+
+        # a record without the fields of the schema - go over each field
+        for inp_field, inp_value in data_point.items():
+
+            match = self.check_data_types(inp_field, inp_value)
+            # check is its filled (if required and matched)
+            if not match:
+                self.data_type_errors[inp_field] += 1
+                if self.error_details is not None and index is not None:
+                    self.add_error_detail(inp_field, "type", index, inp_value)
+
+            required = inp_field in self.is_required
+            #  check if its filled - if it is required
+            if required and match:
+                is_filled = self.check_if_filled(inp_field, inp_value)
+                if not is_filled:
+                    self.error_counter[inp_field] += 1
+                    if self.error_details is not None and index is not None:
+                        self.add_error_detail(inp_field, "required", index, inp_value)
+
+    def count_error_bits(self, errors, index, data_point):
+        """ count the errors in a bit mask of the record checker"""
+        for position, inp_field in enumerate(self.fields):
+            if errors >> position & 1:
+                self.data_type_errors[inp_field] += 1
+                if self.error_details is not None and index is not None:
+                    self.add_error_detail(inp_field, "type", index, data_point[inp_field])
+            elif errors >> (len(self.fields) + position) & 1:
+                self.error_counter[inp_field] += 1
+                if self.error_details is not None and index is not None:
+                    self.add_error_detail(inp_field, "required", index, data_point[inp_field])
+
+    def add_error_detail(self, inp_field, error_kind, index, inp_value):
+        detail = self.error_details.get((inp_field, error_kind))
+        if detail is None:
+            detail = self.error_details[(inp_field, error_kind)] = ErrorDetail(self.error_samples, self.first_errors)
+        detail.add(index, inp_value)
+
+    def error_details_report(self) -> dict:
+        """ the summary of every captured error detail, by field and error kind"""
+        return {f"{inp_field}.{error_kind}": self.error_details[(inp_field, error_kind)].summary()
+                for inp_field, error_kind in sorted(self.error_details or {})}
+
     def total_report_errors_found(self) -> dict:
 
         # go over all blocks in the json file
-
-        for data_point in self.parsed_input:
-
-        # go over each field
-            for inp_field, inp_value in data_point.items():
-
-                match = self.check_data_types(inp_field, inp_value)
-                # check is its filled (if required and matched)
-                if not match:
-                    self.data_type_errors[inp_field] += 1
-
-                required = inp_field in self.is_required
-                #  check if its filled - if it is required
-                if required and match:
-                    is_filled = self.check_if_filled(inp_field, inp_value)
-                    if not is_filled:
-                        self.error_counter[inp_field] += 1
+        for index, data_point in enumerate(self.parsed_input):
+            self.count_record_errors(data_point, index)
 
         self.total_errors_dict = Counter(self.data_type_errors) + Counter(self.error_counter)
 
@@ -166,11 +1106,13 @@ class EzRider:
 
     def find_bus_without_f_s(self, start_stops, final_stops):
         """ find the bus that does not have a s/f stop"""
+        start_set = set(start_stops)
+        final_set = set(final_stops)
         for id in start_stops:
-            if id not in final_stops:
+            if id not in final_set:
                 return id, f"There is no start or end stop for the line: {id}."
         for id in final_stops:
-            if id not in start_stops:
+            if id not in start_set:
                 return id, f"There is no start or end stop for the line: {id}."
 
     def check_field_validity(self,field="stop_type",entry=" "):
@@ -183,34 +1125,88 @@ class EzRider:
             return is_filled
 
 
+    def line_topology_index(self) -> dict:
+        """ the LineTopology of every bus line, built in a single pass over the records the first time it is needed"""
+        if self.line_topology is not None:
+            return self.line_topology
+        self.line_topology = {}
+        for index, data_point in enumerate(self.parsed_input):
+            bus_id, stop_id, stop_name, next_stop, stop_type, a_time = (
+                STOP_RECORD_VALUES if type(data_point) is StopRecord else RECORD_VALUES)(data_point)
+            line = self.line_topology.get(bus_id)
+            if line is None:
+                line = self.line_topology[bus_id] = LineTopology(bus_id, index)
+            line.stop_ids.append(stop_id)
+            line.stop_names.append(stop_name)
+            line.stop_types.append(stop_type)
+            line.next_stops.append(next_stop)
+            line.a_times.append(a_time)
+            if stop_type == "S":
+                line.start_indexes.append(index)
+                if line.start_stop is None:
+                    line.start_stop = stop_name
+            if stop_type == "F":
+                line.final_indexes.append(index)
+                if line.final_stop is None:
+                    line.final_stop = stop_name
+            if line.route_fault is None:
+                valid_stop_name = self.check_data_types("stop_name", stop_name) and self.check_if_filled("stop_name", stop_name)
+                valid_bus_id = self.check_data_types("bus_id", bus_id) and self.check_if_filled("bus_id", bus_id)
+                if not (valid_stop_name and valid_bus_id):
+                    line.route_fault = (index, data_point)
+        return self.line_topology
+
+    def route_graph_index(self) -> dict:
+        """ the LineRoute of every bus line, built from the line topology the first time it is needed"""
+        if self.line_routes is None:
+            self.line_routes = {bus_id: LineRoute.from_topology(line)
+                                for bus_id, line in self.line_topology_index().items()}
+        return self.line_routes
+
+    def route_faults(self) -> dict:
+        """ bus_id -> descriptions of what is wrong with the route of the line, for the lines that are not valid"""
+        faults = {}
+        topology = self.line_topology_index()
+        for bus_id, route in self.route_graph_index().items():
+            line = topology[bus_id]
+            line_faults = [f"next_stop {next_stop} of stop {stop_id} is not on the line"
+                           for stop_id, next_stop in route.dangling]
+            if route.cycle:
+                line_faults.append("the route goes round in a cycle")
+            if route.broken:
+                line_faults.append("the stops do not form a single chain")
+            if route.orphans:
+                line_faults.append(f"stops not on the route: {route.orphans}")
+            if line.start_indexes and line.stop_types[route.order[0]] != "S":
+                line_faults.append("the start stop is not the first stop of the route")
+            if line.final_indexes and line.stop_types[route.order[len(route.order) - len(route.orphans) - 1]] != "F":
+                line_faults.append("the final stop is not the last stop of the route")
+            if line_faults:
+                faults[bus_id] = line_faults
+        return faults
+
     def get_buses_with_starts_finals(self):
-        self.start_stops_buses = []
-        self.final_stops_buses = []
-        self.start_stops = []
-        self.final_stops = []
-        for data_point in self.parsed_input:
-            stop_type = data_point["stop_type"]
-            stop_name = data_point["stop_name"]
-            # check if its filled according to format
-            if self.check_field_validity(field="stop_type",entry=stop_type):
-                bus_id = data_point["bus_id"]
-                if self.check_field_validity(field="bus_id", entry=bus_id):
-                    if stop_type == "S":
-                        if bus_id in self.start_stops_buses:
-                            return bus_id, "has more than one start_stop"
-                        self.start_stops_buses.append(bus_id)
-                        self.start_stops.append(stop_name)
-                    if stop_type == "F":
-                        if bus_id in self.final_stops_buses:
-                            return bus_id, "has more than one final_stop"
-                        self.final_stops_buses.append(bus_id)
-                        self.final_stops.append(stop_name)
+        topology = self.line_topology_index()
+        # lines in the order their start/final stop first appears
+        starts = sorted((line.start_indexes[0], bus_id, line.start_stop)
+                        for bus_id, line in topology.items() if line.start_indexes)
+        finals = sorted((line.final_indexes[0], bus_id, line.final_stop)
+                        for bus_id, line in topology.items() if line.final_indexes)
+        self.start_stops_buses = [bus_id for _, bus_id, _ in starts]
+        self.final_stops_buses = [bus_id for _, bus_id, _ in finals]
+        self.start_stops = [stop_name for _, _, stop_name in starts]
+        self.final_stops = [stop_name for _, _, stop_name in finals]
+
+        # the first repeated start or final stop in the feed
+        clashes = [(line.start_indexes[1], bus_id, "has more than one start_stop")
+                   for bus_id, line in topology.items() if len(line.start_indexes) > 1]
+        clashes += [(line.final_indexes[1], bus_id, "has more than one final_stop")
+                    for bus_id, line in topology.items() if len(line.final_indexes) > 1]
+        if clashes:
+            _, bus_id, error_msg = min(clashes, key=lambda clash: clash[0])
+            return bus_id, error_msg
         return None, "unique"
 
-
-
-
-
     def unqiue_start_final_stops(self):
         """ list and check if start and final stop are unique across all lines"""
         bus_id, unique_status = self.get_buses_with_starts_finals() # create stops and finals lists return if are not unique()
@@ -269,14 +1265,26 @@ class EzRider:
         self.all_stops[data_point["bus_id"]].append(stop_name)
 
 
+    def index_stop_lines(self, all_stops):
+        """ build the inverted index of stop name -> the bus lines that serve it"""
+        self.stop_lines = defaultdict(set)
+        for bus_id, stop_names in all_stops.items():
+            for stop_name in stop_names:
+                self.stop_lines[stop_name].add(bus_id)
+        return self.stop_lines
+
     def find_transfer_stops(self, all_stops):
-        transfer_set = set()
-        for bus_a, bus_b in itertools.combinations(all_stops.keys(), 2):
-            a_set = set(all_stops[bus_a])
-            b_set = set(all_stops[bus_b])
-            a_b_shared_stops = list(a_set.intersection(b_set))
-            transfer_set.update(a_b_shared_stops)
-        return transfer_set
+        """ stops served by more than one line"""
+        stop_lines = self.index_stop_lines(all_stops)
+        return {stop_name for stop_name, bus_ids in stop_lines.items() if len(bus_ids) > 1}
+
+    def lines_serving(self, stop_name) -> set:
+        """ the bus lines that serve a stop, once the routes are mapped"""
+        return set(self.stop_lines.get(stop_name, ()))
+
+    def line_count(self, stop_name) -> int:
+        """ number of bus lines passing through a stop, once the routes are mapped"""
+        return len(self.stop_lines.get(stop_name, ()))
 
     def stops_sepcifier(self):
         # checks if all bus's have unique start and final stops. if not return and instance of the failing bus line
@@ -288,8 +1296,14 @@ class EzRider:
 
         # map routes
         self.all_stops = defaultdict(lambda: [])
-        for data_point in self.parsed_input:
+        topology = self.line_topology_index()
+        route_faults = [line.route_fault for line in topology.values() if line.route_fault is not None]
+        if route_faults:
+            # the first record that can not be mapped raises, as when mapping record by record
+            _, data_point = min(route_faults, key=lambda route_fault: route_fault[0])
             self.add_stop_name(data_point)
+        for bus_id, line in topology.items():
+            self.all_stops[bus_id] = line.stop_names
 
         starts_list = list(set(self.start_stops))
         finals_list = list(set(self.final_stops))
@@ -298,43 +1312,87 @@ class EzRider:
                                        "T": transfer_list,
                                        "F": finals_list}
         [self.stops_sepcifier_report[key].sort() for key in self.stops_sepcifier_report.keys()]
+        self.stops_directory = StopDirectory(self.stops_sepcifier_report, self.stop_lines)
         return self.stops_sepcifier_report
 
-    def stops_time_validation(self):
+    def stop_directory(self):
+        """ the StopDirectory of the feed, classifying its stops the first time it is needed"""
+        if self.stops_directory is None:
+            self.stops_sepcifier()
+        return self.stops_directory
+
+    def stops_time_validation(self, route_order=False):
         """
         Requirements from this function
         1. If the arrival time for the next stop is earlier than or equal to the time of the current stop, stop checking that bus line and remember the name of the incorrect stop.
         2. Display the information for those bus lines that have time anomalies. If all the lines are correct timewise, print OK.
+        with route_order the stops of each line are checked in the order of their next_stop links,
+        instead of the order of the records
         """
-        last_bus_times = defaultdict(lambda: [])
+        self.last_bus_times = defaultdict(lambda: [])
         self.time_anomalies = defaultdict(lambda: [])
+        if not route_order:
+            for data_point in self.parsed_input:
+                self.check_record_time(data_point)
+            return self.time_anomalies
+
+        topology = self.line_topology_index()
+        for bus_id, route in self.route_graph_index().items():
+            line = topology[bus_id]
+            for position in route.order:
+                self.check_record_time({"bus_id": bus_id,
+                                        "a_time": line.a_times[position],
+                                        "stop_name": line.stop_names[position]})
+        return self.time_anomalies
+
+    def check_record_time(self, data_point):
+        """ compare the arrival time of a record with the previous stop of its line"""
+        compact = type(data_point) is StopRecord
+        # validate_data(bus_id, "bus_id") # Todo
+        bus_id = data_point.bus_id if compact else data_point["bus_id"]
+        if self.time_anomalies[bus_id]:
+            #  no need to keep track of a base that has an annomaly
+            return
+        # validate_data(last_arrival_time, "a_time") # todo
+        last_arrival_time = data_point.a_time if compact else data_point["a_time"]
+        if not self.last_bus_times[bus_id]:
+            self.last_bus_times[bus_id] = last_arrival_time
+
+        # check if arrival time is older:
+        is_later = (self.last_bus_times[bus_id] <= last_arrival_time)
+        if not is_later:
+            self.time_anomalies[bus_id] = data_point.stop_name if compact else data_point["stop_name"]
+        self.last_bus_times[bus_id] = last_arrival_time
+
+    def timing_statistics(self):
+        """ travel time statistics of the lines, from the records with a valid bus_id and a_time, in record order"""
+        self.timing_stats = TimingStatistics()
         for data_point in self.parsed_input:
-            # validate_data(bus_id, "bus_id") # Todo
             bus_id = data_point["bus_id"]
-            if self.time_anomalies[bus_id]:
-                #  no need to keep track of a base that has an annomaly
+            a_time = data_point["a_time"]
+            if not (self.check_data_types("bus_id", bus_id) and self.check_data_types("a_time", a_time)):
                 continue
-            # validate_data(last_arrival_time, "a_time") # todo
-            last_arrival_time = data_point["a_time"]
-            if not last_bus_times[bus_id]:
-                last_bus_times[bus_id] = last_arrival_time
-
-            # check if arrival time is older:
-            is_later = (last_bus_times[bus_id] <= last_arrival_time)
-            if not is_later:
-                self.time_anomalies[bus_id] = data_point["stop_name"]
-            last_bus_times[bus_id] = last_arrival_time
-        return self.time_anomalies
+            self.timing_stats.add_stop(bus_id, data_point["stop_name"], time_minutes(a_time))
+        return self.timing_stats.finish()
+
+    def journey_planner(self, transfer_minutes=0):
+        """ the JourneyPlanner of the feed, changing buses at the transfer stops found by stops_sepcifier"""
+        self.materialize_input()
+        directory = self.stop_directory()
+        transfer_stops = [stop_name for stop_name in directory if directory.is_transfer(stop_name)]
+        return JourneyPlanner.from_topology(self.line_topology_index(), transfer_stops, self, transfer_minutes)
+
+    def timetable(self):
+        """ the Timetable of the feed, for next departure and calling line lookups"""
+        return Timetable.from_records(self.parsed_input, self)
 
     def validate_on_demand_stops(self):
         self.on_demand_faults = []
         self.stops_sepcifier() # generate the report
-        for data_point in self.parsed_input:
-            if data_point["stop_type"] != "O":
-                continue
-            stop = data_point["stop_name"]
-            if any(stop in val for val in self.stops_sepcifier_report.values()):
-                self.on_demand_faults.append(stop)
+        for line in self.line_topology_index().values():
+            for stop_type, stop in zip(line.stop_types, line.stop_names):
+                if stop_type == "O" and self.stops_directory.is_route_stop(stop):
+                    self.on_demand_faults.append(stop)
         self.on_demand_faults = sorted(self.on_demand_faults)
 
 
@@ -346,75 +1404,919 @@ class EzRider:
         # for every stop, check if its not an on-damnd stop
         #
 
+    def start_audit(self):
+        """ reset the state that audit_record fills for all six stages"""
+        self.data_type_errors = dict.fromkeys(self.fields, 0)
+        self.error_counter = dict.fromkeys(self.fields, 0)
+        self.error_details = {} if self.error_samples else None
+        self.stops_report = {}
+        self.line_first_seen = {}  # bus_id -> index of its first record
+        self.start_seen = {}  # bus_id -> (index, stop_name) of its start stop
+        self.final_seen = {}  # bus_id -> (index, stop_name) of its final stop
+        self.start_final_clash = None  # (index, bus_id, error message) of the first repeated start/final stop
+        self.route_fault = None  # index of the first record that can not be mapped on a route
+        self.all_stops = defaultdict(lambda: [])
+        self.last_bus_times = defaultdict(lambda: [])
+        self.time_anomalies = defaultdict(lambda: [])
+        self.time_fault = None  # the exception that stopped the arrival time test
+        self.on_demand_stops = []
+        self.audit_failures = {}
 
+    def audit_record(self, index, data_point):
+        """ feed a single record to the checks of every stage at once"""
+        # stage one and two - types, formats and required fields
+        self.count_record_errors(data_point, index)
 
-def report_format(format_type, ezrider, stop_time_validation_report=0, tot_err=0, stops_report=0):
+        if type(data_point) is StopRecord:
+            bus_id, stop_name, stop_type = data_point.bus_id, data_point.stop_name, data_point.stop_type
+        else:
+            bus_id, stop_name, stop_type = data_point["bus_id"], data_point["stop_name"], data_point["stop_type"]
+        self.line_first_seen.setdefault(bus_id, index)
+        valid_bus_id = self.check_data_types("bus_id", bus_id) and self.check_if_filled("bus_id", bus_id)
+
+        # stage three - stops per line
+        if valid_bus_id:
+            self.stops_report[bus_id] = self.stops_report.get(bus_id, 0) + 1
+
+        # stage four - start and final stops, and the route of each line
+        if self.start_final_clash is None:
+            for line_type, seen, error_msg in (("S", self.start_seen, "has more than one start_stop"),
+                                               ("F", self.final_seen, "has more than one final_stop")):
+                if stop_type != line_type:
+                    continue
+                if bus_id in seen:
+                    self.start_final_clash = (index, bus_id, error_msg)
+                else:
+                    seen[bus_id] = (index, stop_name)
+        valid_stop_name = self.check_data_types("stop_name", stop_name) and self.check_if_filled("stop_name", stop_name)
+        if valid_stop_name and valid_bus_id:
+            self.all_stops[bus_id].append(stop_name)
+        elif self.route_fault is None:
+            self.route_fault = index
+
+        # stage five - arrival times
+        if self.time_fault is None:
+            try:
+                self.check_record_time(data_point)
+            except TypeError as error:
+                self.time_fault = error
+
+        # stage six - on demand stops, checked against the stop types once all lines are known
+        if stop_type == "O":
+            self.on_demand_stops.append(stop_name)
+
+    def bad_bus_line(self):
+        """ return the (bus_id, error message) of a line with a missing or repeated start/final stop,
+        like unqiue_start_final_stops does"""
+        if self.start_final_clash is not None:
+            _, bus_id, error_msg = self.start_final_clash
+            return bus_id, error_msg
+        # lines in the order their start/final stop first appeared
+        self.start_stops_buses = sorted(self.start_seen, key=lambda bus_id: self.start_seen[bus_id][0])
+        self.final_stops_buses = sorted(self.final_seen, key=lambda bus_id: self.final_seen[bus_id][0])
+        if set(self.start_stops_buses) != set(self.final_stops_buses):
+            return self.find_bus_without_f_s(self.start_stops_buses, self.final_stops_buses)
+        return None, "unique"
+
+    def finish_audit(self, transfer_stops=None):
+        """ turn the state collected by audit_record into the reports of every stage"""
+        self.total_errors_dict = Counter(self.data_type_errors) + Counter(self.error_counter)
+        if self.time_fault is not None:
+            self.audit_failures["stage_five"] = self.time_fault
+
+        bad_bus, error_msg = self.bad_bus_line()
+        if bad_bus:
+            route_failure = BadBusException(error_msg)
+        elif self.route_fault is not None:
+            route_failure = FormatError("format or requirement not fulfilled")
+        else:
+            route_failure = None
+        if route_failure is not None:
+            self.audit_failures["stage_four"] = route_failure
+            self.audit_failures["stage_six"] = route_failure
+            return
+
+        self.start_stops = [stop_name for _, stop_name in self.start_seen.values()]
+        self.final_stops = [stop_name for _, stop_name in self.final_seen.values()]
+        self.stops_sepcifier_report = {"S": sorted(set(self.start_stops)),
+                                       "T": sorted(self.find_transfer_stops(self.all_stops)
+                                                   if transfer_stops is None else transfer_stops),
+                                       "F": sorted(set(self.final_stops))}
+        self.stops_directory = StopDirectory(self.stops_sepcifier_report, self.stop_lines)
+        self.on_demand_faults = sorted(stop for stop in self.on_demand_stops
+                                       if self.stops_directory.is_route_stop(stop))
+
+    def audit(self) -> dict:
+        """ run the checks of all six stages in a single pass over the records.
+        returns the report of every stage, stages that failed are listed in self.audit_failures instead"""
+        self.start_audit()
+        for index, data_point in enumerate(self.parsed_input):
+            self.audit_record(index, data_point)
+        self.finish_audit()
+        return self.audit_reports()
+
+    def audit_state(self) -> dict:
+        """ the state collected by audit_record, in a form that can be sent between processes"""
+        return {"data_type_errors": self.data_type_errors,
+                "error_counter": self.error_counter,
+                "error_details": self.error_details,
+                "stops_report": self.stops_report,
+                "line_first_seen": self.line_first_seen,
+                "start_seen": self.start_seen,
+                "final_seen": self.final_seen,
+                "start_final_clash": self.start_final_clash,
+                "route_fault": self.route_fault,
+                "all_stops": dict(self.all_stops),
+                "time_anomalies": dict(self.time_anomalies),
+                "time_fault": self.time_fault,
+                "on_demand_stops": self.on_demand_stops}
+
+    def merge_audit_state(self, state):
+        """ add the state of a shard holding whole bus lines to this audit"""
+        for inp_field, count in state["data_type_errors"].items():
+            self.data_type_errors[inp_field] += count
+        for inp_field, count in state["error_counter"].items():
+            self.error_counter[inp_field] += count
+        for key, detail in (state["error_details"] or {}).items():
+            if key in self.error_details:
+                self.error_details[key].merge(detail)
+            else:
+                self.error_details[key] = detail
+        self.line_first_seen.update(state["line_first_seen"])
+        self.stops_report.update(state["stops_report"])
+        self.start_seen.update(state["start_seen"])
+        self.final_seen.update(state["final_seen"])
+        self.all_stops.update(state["all_stops"])
+        self.time_anomalies.update(state["time_anomalies"])
+        self.on_demand_stops += state["on_demand_stops"]
+        # keep the fault that comes first in the feed
+        if state["start_final_clash"] is not None:
+            if self.start_final_clash is None or state["start_final_clash"][0] < self.start_final_clash[0]:
+                self.start_final_clash = state["start_final_clash"]
+        if state["route_fault"] is not None:
+            if self.route_fault is None or state["route_fault"] < self.route_fault:
+                self.route_fault = state["route_fault"]
+        if self.time_fault is None:
+            self.time_fault = state["time_fault"]
+
+    def audit_parallel(self, workers=None, shards=None) -> dict:
+        """ run audit with the bus lines split into shards that are checked in worker processes.
+        gives the same reports as audit"""
+        workers = workers or os.cpu_count() or 1
+        shards = shards or workers
+        # partition the records by bus_id, so each line is checked by a single worker
+        sharded_records = [[] for _ in range(shards)]
+        for index, data_point in enumerate(self.parsed_input):
+            sharded_records[hash(data_point["bus_id"]) % shards].append((index, data_point))
+
+        self.start_audit()
+        shard_audit = functools.partial(audit_shard, **self.check_options())
+        self.worker_memo_stats = defaultdict(Counter)  # field -> hits and misses of the memos of the workers
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for state in executor.map(shard_audit, sharded_records):
+                self.merge_audit_state(state)
+                for inp_field, field_stats in (state.get("memo_stats") or {}).items():
+                    self.worker_memo_stats[inp_field].update(field_stats)
+
+        # report lines in the order they first appear in the feed, as a serial audit does
+        first_seen = self.line_first_seen
+        self.stops_report = dict(sorted(self.stops_report.items(), key=lambda item: first_seen[item[0]]))
+        self.time_anomalies = defaultdict(lambda: [], sorted(self.time_anomalies.items(),
+                                                             key=lambda item: first_seen[item[0]]))
+        self.finish_audit()
+        return self.audit_reports()
+
+    def start_incremental(self):
+        """ audit the records line by line and keep them, keyed by (bus_id, stop_id), for apply_changes.
+        when several lines are faulty, the first one in line order is reported"""
+        self.start_audit()
+        self.lines = {}  # bus_id -> {stop_id: (sequence, record) pairs}, more than one when the feed repeats a stop
+        self.records_stored = 0  # sequence number of the next record, to keep the records in the order they came
+        self.line_order = {}  # bus_id -> sequence number, in the order the lines were added
+        self.line_states = {}  # bus_id -> audit_state of the line
+        self.stop_lines = defaultdict(set)
+        self.transfer_stops = set()
+        for data_point in self.parsed_input:
+            self.upsert_record(data_point, replace=False)
+        self.revalidate_lines(list(self.lines))
+        return self.audit_reports()
 
+    def upsert_record(self, data_point, replace=True):
+        """ store a record, in place of the records of its stop unless replace is off.
+        a record replacing others takes the place of the first one, a new stop goes after the records already there"""
+        bus_id = data_point["bus_id"]
+        if bus_id not in self.lines:
+            self.lines[bus_id] = {}
+            self.line_order[bus_id] = len(self.line_order)
+        stop_records = self.lines[bus_id].setdefault(data_point["stop_id"], [])
+        if replace and stop_records:
+            sequence = stop_records[0][0]
+            stop_records.clear()
+        else:
+            sequence = self.records_stored
+            self.records_stored += 1
+        stop_records.append((sequence, data_point))
+
+    def apply_changes(self, upserts=(), deletes=()) -> dict:
+        """ insert or update records and delete (bus_id, stop_id) keys, then revalidate only the lines they touch.
+        returns the report of every stage, as audit does"""
+        touched = {}
+        for bus_id, stop_id in deletes:
+            self.lines.get(bus_id, {}).pop(stop_id, None)
+            touched[bus_id] = True
+        for data_point in upserts:
+            self.upsert_record(data_point)
+            touched[data_point["bus_id"]] = True
+        self.revalidate_lines(list(touched))
+        return self.audit_reports()
+
+    def revalidate_lines(self, bus_ids):
+        """ replace the contribution of the given lines to the audit by their current state"""
+        for bus_id in bus_ids:
+            self.remove_line_state(bus_id)
+            if not self.lines.get(bus_id):
+                self.lines.pop(bus_id, None)
+                self.line_order.pop(bus_id, None)
+                continue
+            line = EzRider([], **self.check_options())
+            line.start_audit()
+            sequence = self.line_order[bus_id]
+            # the records of the line in feed order, as audit checks them
+            stored = sorted((stored for stop_records in self.lines[bus_id].values() for stored in stop_records),
+                            key=lambda stored: stored[0])
+            for position, (_, data_point) in enumerate(stored):
+                line.audit_record((sequence, position), data_point)
+            self.add_line_state(bus_id, line.audit_state())
+
+        # faults come from the first line that has one
+        states = [self.line_states[bus_id] for bus_id in sorted(self.line_states, key=self.line_order.get)]
+        self.start_final_clash = min((state["start_final_clash"] for state in states
+                                      if state["start_final_clash"] is not None), default=None)
+        self.route_fault = min((state["route_fault"] for state in states
+                                if state["route_fault"] is not None), default=None)
+        self.time_fault = next((state["time_fault"] for state in states if state["time_fault"] is not None), None)
+        self.on_demand_stops = [stop for state in states for stop in state["on_demand_stops"]]
+        if self.error_details is not None:
+            # details can not be taken out again, so they are merged anew from the lines
+            self.error_details = {}
+            for state in states:
+                for key, detail in state["error_details"].items():
+                    if key not in self.error_details:
+                        self.error_details[key] = ErrorDetail(self.error_samples, self.first_errors)
+                    self.error_details[key].merge(detail)
+        self.audit_failures = {}
+        self.finish_audit(transfer_stops=self.transfer_stops)
+
+    def add_line_state(self, bus_id, state):
+        self.line_states[bus_id] = state
+        for inp_field, count in state["data_type_errors"].items():
+            self.data_type_errors[inp_field] += count
+        for inp_field, count in state["error_counter"].items():
+            self.error_counter[inp_field] += count
+        for name in ("line_first_seen", "stops_report", "start_seen", "final_seen", "all_stops", "time_anomalies"):
+            if bus_id in state[name]:
+                getattr(self, name)[bus_id] = state[name][bus_id]
+        for stop_name in set(state["all_stops"].get(bus_id, ())):
+            self.stop_lines[stop_name].add(bus_id)
+            if len(self.stop_lines[stop_name]) > 1:
+                self.transfer_stops.add(stop_name)
+
+    def remove_line_state(self, bus_id):
+        state = self.line_states.pop(bus_id, None)
+        if state is None:
+            return
+        for inp_field, count in state["data_type_errors"].items():
+            self.data_type_errors[inp_field] -= count
+        for inp_field, count in state["error_counter"].items():
+            self.error_counter[inp_field] -= count
+        if not self.lines.get(bus_id):
+            for name in ("line_first_seen", "stops_report", "time_anomalies"):
+                getattr(self, name).pop(bus_id, None)
+        # a line that is still there is overwritten in place by add_line_state, to keep its place in the reports
+        for name in ("start_seen", "final_seen", "all_stops"):
+            getattr(self, name).pop(bus_id, None)
+        for stop_name in set(state["all_stops"].get(bus_id, ())):
+            self.stop_lines[stop_name].discard(bus_id)
+            if len(self.stop_lines[stop_name]) < 2:
+                self.transfer_stops.discard(stop_name)
+            if not self.stop_lines[stop_name]:
+                del self.stop_lines[stop_name]
+
+    def audit_reports(self) -> dict:
+        """ render the report of every stage that did not fail"""
+        reports = {}
+        for stage in STAGES:
+            if stage in self.audit_failures:
+                continue
+            if stage in ("stage_one", "stage_two"):
+                reports[stage] = report_format(stage, self, tot_err=self.get_tot_error())
+            elif stage == "stage_three":
+                reports[stage] = report_format(stage, self, stops_report=self.stops_report)
+            else:
+                reports[stage] = report_format(stage, self)
+        return reports
+
+    def columnar_store(self):
+        """ load the records into a ColumnarFeed, validated with this instance's validators"""
+        return ColumnarFeed.from_records(self.parsed_input, self)
+
+
+class ColumnarFeed:
+    """ the records of a feed stored column by column in typed arrays, with a validity mask per column.
+    the stage checks run as vectorized numpy operations over the columns"""
+
+    def __init__(self, ezrider):
+        if np is None:
+            raise ImportError("the columnar store requires numpy")
+        self.fields = ezrider.fields
+        self.is_required = ezrider.is_required
+        self.stop_names = []  # stop name id -> stop name
+        self.stop_name_ids = {}  # stop name -> stop name id
+        self.raw_stop_names = {}  # record index -> stop name that is not a string, stored as id -1
+        self.columns = {}
+        self.valid = {}  # field -> mask of the records whose value has the right type and format
+        self.empty = {}  # field -> mask of the records whose value is ""
+
+    @classmethod
+    def from_records(cls, records, ezrider):
+        """ build the columns in a single pass over the records"""
+        feed = cls(ezrider)
+        validators = ezrider.dtypes_list
+        columns = {"bus_id": array("q"), "stop_id": array("q"), "next_stop": array("q"),
+                   "stop_name": array("i"), "stop_type": array("B"), "a_time": array("h")}
+        valid = {field_name: array("B") for field_name in columns}
+        empty = {field_name: array("B") for field_name in columns}
+
+        for index, data_point in enumerate(records):
+            for field_name in columns:
+                value = data_point[field_name]
+                is_valid = validators[field_name](value)
+                valid[field_name].append(is_valid)
+                empty[field_name].append(value == "")
+                if field_name == "stop_name":
+                    if type(value) == str:
+                        columns[field_name].append(feed.intern_stop_name(value))
+                    else:
+                        feed.raw_stop_names[index] = value
+                        columns[field_name].append(-1)
+                elif field_name == "a_time":
+                    # minutes since midnight
+                    columns[field_name].append(int(value[:2]) * 60 + int(value[3:]) if is_valid else -1)
+                elif field_name == "stop_type":
+                    columns[field_name].append(ord(value) if is_valid and value else 0)
+                else:
+                    columns[field_name].append(value if is_valid else 0)
+
+        dtypes = {"q": np.int64, "i": np.int32, "B": np.uint8, "h": np.int16}
+        for field_name, column in columns.items():
+            feed.columns[field_name] = np.frombuffer(column, dtype=dtypes[column.typecode])
+            feed.valid[field_name] = np.frombuffer(valid[field_name], dtype=np.uint8).astype(bool)
+            feed.empty[field_name] = np.frombuffer(empty[field_name], dtype=np.uint8).astype(bool)
+        return feed
+
+    def intern_stop_name(self, stop_name):
+        stop_name_id = self.stop_name_ids.get(stop_name)
+        if stop_name_id is None:
+            stop_name_id = self.stop_name_ids[stop_name] = len(self.stop_names)
+            self.stop_names.append(stop_name)
+        return stop_name_id
+
+    def stop_name(self, record):
+        """ the stop name of a record, as it was in the feed"""
+        stop_name_id = self.columns["stop_name"][record]
+        return self.raw_stop_names[record] if stop_name_id == -1 else self.stop_names[stop_name_id]
+
+    def __len__(self):
+        return len(self.columns["bus_id"])
+
+    def total_report_errors_found(self):
+        self.data_type_errors = {field_name: int(np.count_nonzero(~self.valid[field_name]))
+                                 for field_name in self.fields}
+        self.error_counter = dict.fromkeys(self.fields, 0)
+        for field_name in self.is_required:
+            self.error_counter[field_name] = int(np.count_nonzero(self.valid[field_name] & self.empty[field_name]))
+        self.total_errors_dict = Counter(self.data_type_errors) + Counter(self.error_counter)
+
+    def get_tot_error(self):
+        return sum(self.total_errors_dict.values())
+
+    def lines_first_seen(self):
+        """ the valid bus ids in the order they first appear, with the number of records of each"""
+        bus_ids = self.columns["bus_id"][self.valid["bus_id"]]
+        lines, first_index, counts = np.unique(bus_ids, return_index=True, return_counts=True)
+        order = np.argsort(first_index, kind="stable")
+        return lines[order], counts[order]
+
+    def stops_counter(self):
+        lines, counts = self.lines_first_seen()
+        self.stops_report = dict(zip(lines.tolist(), counts.tolist()))
+        return self.stops_report
+
+    def route_ordered_records(self):
+        """ the indexes of the records with a valid bus_id, line by line in the order of their next_stop links,
+        as EzRider.route_graph_index orders them"""
+        records = np.flatnonzero(self.valid["bus_id"])
+        line_records = defaultdict(list)  # in the order the lines first appear
+        for record, bus_id in zip(records.tolist(), self.columns["bus_id"][records].tolist()):
+            line_records[bus_id].append(record)
+        stop_ids = self.columns["stop_id"].tolist()
+        next_stops = self.columns["next_stop"].tolist()
+        stop_types = self.columns["stop_type"].tolist()
+        ordered = []
+        for bus_id, records in line_records.items():
+            line = LineTopology(bus_id, records[0], stop_ids=[stop_ids[record] for record in records],
+                                next_stops=[next_stops[record] for record in records],
+                                stop_types=[chr(stop_types[record]) if stop_types[record] else ""
+                                            for record in records])
+            ordered += [records[position] for position in LineRoute.from_topology(line).order]
+        return np.array(ordered, dtype=np.int64)
+
+    def stops_time_validation(self, route_order=False):
+        """ the first stop of each line that arrives earlier than the stop before it,
+        over the records whose bus_id and a_time are valid.
+        with route_order the stops of each line are checked in the order of their next_stop links"""
+        if route_order:
+            selected = self.route_ordered_records()
+            selected = selected[self.valid["a_time"][selected]]
+            order = np.arange(len(selected))  # the records of each line are together already
+        else:
+            selected = np.flatnonzero(self.valid["bus_id"] & self.valid["a_time"])
+            # group the records of each line, keeping their order
+            order = np.argsort(self.columns["bus_id"][selected], kind="stable")
+        bus_ids = self.columns["bus_id"][selected][order]
+        a_times = self.columns["a_time"][selected][order]
+        earlier = (bus_ids[1:] == bus_ids[:-1]) & (a_times[1:] < a_times[:-1])
+        positions = np.flatnonzero(earlier) + 1
+        # positions are sorted by line, so the first one of each line is its first anomaly
+        anomaly_lines, first = np.unique(bus_ids[positions], return_index=True)
+        records = selected[order[positions[first]]]
+        anomalies = dict(zip(anomaly_lines.tolist(),
+                             [self.stop_name(record) for record in records.tolist()]))
+
+        # report the lines in the order they first appear
+        lines, _ = self.lines_first_seen()
+        self.time_anomalies = {bus_id: anomalies[bus_id] for bus_id in lines.tolist() if bus_id in anomalies}
+        return self.time_anomalies
+
+
+class ResultCache:
+    """ on disk cache of the stage reports of a feed, keyed by a hash of the feed and of the validator configuration.
+    entries are written atomically, so processes can share a directory, and the least recently used
+    entries are evicted once the directory grows past max_bytes"""
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        config = json.dumps(EzRider([]).validator_config(), sort_keys=True)
+        self.config_digest = hashlib.sha256(config.encode()).digest()
+
+    def key(self, user_input) -> str:
+        digest = hashlib.sha256(self.config_digest)
+        digest.update(user_input.encode())
+        return digest.hexdigest()
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """ the cached entry, or None"""
+        try:
+            with open(self.path(key)) as entry_file:
+                entry = json.load(entry_file)
+            os.utime(self.path(key))  # mark as recently used
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        # write to a temporary file first, so readers never see half an entry
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temporary_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """ delete the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def audit(self, user_input) -> dict:
+        """ the reports of every stage for a feed, and the messages of the stages that failed"""
+        key = self.key(user_input)
+        entry = self.get(key)
+        if entry is None:
+            ezrider = EzRider(user_input)
+            entry = {"reports": ezrider.audit(),
+                     "failures": {stage: str(error) for stage, error in ezrider.audit_failures.items()}}
+            self.put(key, entry)
+        return entry
+
+
+# snapshot file layout, little endian. records and lines are fixed width, stop names are sorted by their UTF-8 bytes
+SNAPSHOT_MAGIC = b"EZRS"
+SNAPSHOT_VERSION = 1
+# magic, version, reserved, record count, line count, stop name count, offsets of the 7 sections
+SNAPSHOT_HEADER = struct.Struct("<4sHHIII7Q")
+# bus_id, stop_id, next_stop, stop name id, a_time in minutes, stop_type char, bit per valid field
+SNAPSHOT_RECORD = struct.Struct("<qqqihBB")
+# bus_id, first record, record count, start stop name id, final stop name id
+SNAPSHOT_LINE = struct.Struct("<qIIii")
+SNAPSHOT_U32 = struct.Struct("<I")
+SNAPSHOT_CLASSES = {"S": 1, "T": 2, "F": 4}  # classification bits of a stop name
+
+def save_snapshot(ezrider, path):
+    """ write the validated network of an EzRider to a snapshot file that NetworkSnapshot opens without parsing.
+    raises like stops_sepcifier when the lines are not valid"""
+    report = ezrider.stops_sepcifier()
+    topology = ezrider.line_topology_index()
+    stop_names = sorted({stop_name for line in topology.values() for stop_name in line.stop_names
+                         if type(stop_name) == str}, key=lambda stop_name: stop_name.encode())
+    stop_name_ids = {stop_name: stop_name_id for stop_name_id, stop_name in enumerate(stop_names)}
+
+    records = bytearray()
+    lines = bytearray()
+    stop_lines = defaultdict(set)  # stop name id -> line numbers
+    record_count = 0
+    for line_number, bus_id in enumerate(sorted(topology)):
+        line = topology[bus_id]
+        lines += SNAPSHOT_LINE.pack(bus_id, record_count, len(line.stop_ids),
+                                    stop_name_ids.get(line.start_stop, -1), stop_name_ids.get(line.final_stop, -1))
+        for stop_id, stop_name, next_stop, stop_type, a_time in zip(line.stop_ids, line.stop_names, line.next_stops,
+                                                                    line.stop_types, line.a_times):
+            values = {"bus_id": bus_id, "stop_id": stop_id, "next_stop": next_stop,
+                      "stop_name": stop_name, "stop_type": stop_type, "a_time": a_time}
+            valid = [ezrider.check_data_types(inp_field, values[inp_field]) for inp_field in StopRecord.__slots__]
+            valid_bits = sum(1 << bit for bit, is_valid in enumerate(valid) if is_valid)
+            stop_name_id = stop_name_ids.get(stop_name, -1) if type(stop_name) == str else -1
+            records += SNAPSHOT_RECORD.pack(bus_id,
+                                            stop_id if valid[1] else 0,
+                                            next_stop if valid[3] else 0,
+                                            stop_name_id,
+                                            int(a_time[:2]) * 60 + int(a_time[3:]) if valid[5] else -1,
+                                            ord(stop_type) if valid[4] and stop_type else 0,
+                                            valid_bits)
+            if stop_name_id >= 0:
+                stop_lines[stop_name_id].add(line_number)
+            record_count += 1
+
+    encoded_names = [stop_name.encode() for stop_name in stop_names]
+    name_offsets = bytearray()
+    name_data = bytearray()
+    for encoded_name in encoded_names:
+        name_offsets += SNAPSHOT_U32.pack(len(name_data))
+        name_data += encoded_name
+    name_offsets += SNAPSHOT_U32.pack(len(name_data))
+    class_stops = {stop_type: set(report[stop_type]) for stop_type in SNAPSHOT_CLASSES}
+    classes = bytes(sum(bit for stop_type, bit in SNAPSHOT_CLASSES.items() if stop_name in class_stops[stop_type])
+                    for stop_name in stop_names)
+    stop_lines_offsets = bytearray()
+    stop_lines_data = bytearray()
+    for stop_name_id in range(len(stop_names)):
+        stop_lines_offsets += SNAPSHOT_U32.pack(len(stop_lines_data) // SNAPSHOT_U32.size)
+        for line_number in sorted(stop_lines[stop_name_id]):
+            stop_lines_data += SNAPSHOT_U32.pack(line_number)
+    stop_lines_offsets += SNAPSHOT_U32.pack(len(stop_lines_data) // SNAPSHOT_U32.size)
+
+    sections = [records, lines, name_offsets, name_data, classes, stop_lines_offsets, stop_lines_data]
+    offsets = []
+    position = SNAPSHOT_HEADER.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, record_count, len(topology), len(stop_names),
+                                  *offsets)
+    # write next to the target and move it in place, so readers never open half a snapshot
+    handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(handle, "wb") as snapshot_file:
+        snapshot_file.write(header)
+        for section in sections:
+            snapshot_file.write(section)
+    os.replace(temporary_path, path)
+
+
+class NetworkSnapshot:
+    """ read-only view of a snapshot file written by save_snapshot, memory mapped so that opening it costs
+    nothing and every query reads only the bytes it needs"""
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self.buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.record_count, self.line_count, self.stop_name_count,
+         *offsets) = SNAPSHOT_HEADER.unpack_from(self.buffer, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.buffer.close()
+            raise FormatError("not an easyrider snapshot of a known version")
+        (self.records_offset, self.lines_offset, self.name_offsets_offset, self.name_data_offset,
+         self.classes_offset, self.stop_lines_offsets_offset, self.stop_lines_offset) = offsets
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _u32(self, offset, index):
+        return SNAPSHOT_U32.unpack_from(self.buffer, offset + index * SNAPSHOT_U32.size)[0]
+
+    def _name_bytes(self, stop_name_id):
+        start = self.name_data_offset + self._u32(self.name_offsets_offset, stop_name_id)
+        end = self.name_data_offset + self._u32(self.name_offsets_offset, stop_name_id + 1)
+        return self.buffer[start:end]
+
+    def stop_name(self, stop_name_id) -> str:
+        return self._name_bytes(stop_name_id).decode()
+
+    def stop_name_id(self, stop_name):
+        """ the id of a stop name, found by binary search over the sorted names, or None"""
+        encoded_name = stop_name.encode()
+        low, high = 0, self.stop_name_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_bytes(middle) < encoded_name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.stop_name_count and self._name_bytes(low) == encoded_name:
+            return low
+        return None
+
+    def stop_names(self) -> list:
+        return [self.stop_name(stop_name_id) for stop_name_id in range(self.stop_name_count)]
+
+    def _line(self, line_number):
+        return SNAPSHOT_LINE.unpack_from(self.buffer, self.lines_offset + line_number * SNAPSHOT_LINE.size)
+
+    def lines(self) -> list:
+        """ the bus ids of all lines, sorted"""
+        return [self._line(line_number)[0] for line_number in range(self.line_count)]
+
+    def line_number(self, bus_id):
+        """ the position of a line in the line index, found by binary search, or None"""
+        low, high = 0, self.line_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._line(middle)[0] < bus_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.line_count and self._line(low)[0] == bus_id:
+            return low
+        return None
+
+    def line_ends(self, bus_id):
+        """ the (start stop, final stop) names of a line, or None"""
+        line_number = self.line_number(bus_id)
+        if line_number is None:
+            return None
+        _, _, _, start_id, final_id = self._line(line_number)
+        return (self.stop_name(start_id) if start_id >= 0 else None,
+                self.stop_name(final_id) if final_id >= 0 else None)
+
+    def _record(self, record_number):
+        bus_id, stop_id, next_stop, stop_name_id, a_time, stop_type, valid_bits = SNAPSHOT_RECORD.unpack_from(
+            self.buffer, self.records_offset + record_number * SNAPSHOT_RECORD.size)
+        # fields that were not valid when the snapshot was saved come back as None
+        values = [bus_id, stop_id,
+                  self.stop_name(stop_name_id) if stop_name_id >= 0 else None,
+                  next_stop,
+                  chr(stop_type) if stop_type else "",
+                  f"{a_time // 60:02d}:{a_time % 60:02d}" if a_time >= 0 else None]
+        return StopRecord(*[value if valid_bits & (1 << bit) else None for bit, value in enumerate(values)])
+
+    def line_stops(self, bus_id) -> list:
+        """ the records of a line, as StopRecord objects"""
+        line_number = self.line_number(bus_id)
+        if line_number is None:
+            return []
+        _, first_record, record_count, _, _ = self._line(line_number)
+        return [self._record(record_number) for record_number in range(first_record, first_record + record_count)]
+
+    def records(self):
+        for record_number in range(self.record_count):
+            yield self._record(record_number)
+
+    def stop_classification(self, stop_name) -> set:
+        """ which of start (S), transfer (T) and finish (F) a stop is"""
+        stop_name_id = self.stop_name_id(stop_name)
+        if stop_name_id is None:
+            return set()
+        classes = self.buffer[self.classes_offset + stop_name_id]
+        return {stop_type for stop_type, bit in SNAPSHOT_CLASSES.items() if classes & bit}
+
+    def lines_serving(self, stop_name) -> list:
+        stop_name_id = self.stop_name_id(stop_name)
+        if stop_name_id is None:
+            return []
+        start = self._u32(self.stop_lines_offsets_offset, stop_name_id)
+        end = self._u32(self.stop_lines_offsets_offset, stop_name_id + 1)
+        return [self._line(self._u32(self.stop_lines_offset, index))[0] for index in range(start, end)]
+
+
+RESULT_CACHE = None  # the ResultCache used by the stage functions, set by use_result_cache
+
+def use_result_cache(directory, max_bytes=256 * 1024 * 1024):
+    """ cache the stage reports in directory from now on, or stop caching when directory is None"""
+    global RESULT_CACHE
+    RESULT_CACHE = ResultCache(directory, max_bytes) if directory is not None else None
+    return RESULT_CACHE
+
+def cached_stage(stage_function):
+    """ answer a stage from the result cache when one is in use.
+    failed stages are not cached, they run again so they raise as before"""
+    @functools.wraps(stage_function)
+    def wrapper(user_input, *args, **kwargs):
+        if RESULT_CACHE is None or not isinstance(user_input, str):
+            return stage_function(user_input, *args, **kwargs)
+        entry = RESULT_CACHE.audit(user_input)
+        if stage_function.__name__ == "stage_all":
+            reports = dict(entry["reports"], **entry["failures"])
+            return {stage: reports[stage] for stage in STAGES}
+        if stage_function.__name__ in entry["reports"]:
+            return entry["reports"][stage_function.__name__]
+        return stage_function(user_input, *args, **kwargs)
+    return wrapper
+
+
+def iter_list_repr(items):
+    """ the pieces of repr(list(items)), without building the list or its text"""
+    yield "["
+    for index, item in enumerate(items):
+        yield (", " if index else "") + repr(item)
+    yield "]"
+
+def iter_text_report(format_type, ezrider, tot_err=0, stops_report=0):
+    """ the text report of a stage, piece by piece"""
     if format_type == "stage_six":
-        report = ["On demand stops test:"]
+        yield "On demand stops test:\n"
         # check if all is good
         if not any(ezrider.on_demand_faults):
-            report.append("OK")
-            parsed_report = "\n".join(report)
-            return parsed_report
-
-        report.append(f"Wrong stop type: {ezrider.on_demand_faults}")
-
-        parsed_report = "\n".join(report)
-        return parsed_report
+            yield "OK"
+            return
+        yield "Wrong stop type: "
+        yield from iter_list_repr(ezrider.on_demand_faults)
 
     if format_type == "stage_five":
-        report = ["Arrival time test:"]
+        yield "Arrival time test:"
         # check if all is good
         if not any(ezrider.time_anomalies.values()):
-            report.append("OK")
-            parsed_report = "\n".join(report)
-            return parsed_report
-
+            yield "\nOK"
+            return
         for bus_id, stop_name in ezrider.time_anomalies.items():
             if stop_name == []:
                 continue
-            report.append(f"bus_id line {bus_id}: wrong time on station {stop_name}")
-
-        parsed_report = "\n".join(report)
-        return parsed_report
+            yield f"\nbus_id line {bus_id}: wrong time on station {stop_name}"
 
     if format_type == "stage_four":
         # check if report stopped becuase of a bus line information miss
         if type(ezrider.stops_sepcifier_report) == int:
             print(f"There is no start or end stop for the line: {ezrider.stops_sepcifier_report}")
 
-        report = []
         headlines = {"S": "Start", "T": "Transfer", "F": "Finish"}
-
-        for stop_type, headline in headlines.items():
+        for index, (stop_type, headline) in enumerate(headlines.items()):
             stop_list = ezrider.stops_sepcifier_report[stop_type]
-            total_stops = len(ezrider.stops_sepcifier_report[stop_type])
-            report += [f"{headline} stops: {total_stops} {stop_list}"]
-        parsed_report = "\n".join(report)
-        return parsed_report
+            yield ("\n" if index else "") + f"{headline} stops: {len(stop_list)} "
+            yield from iter_list_repr(stop_list)
 
     if format_type == "stage_three":
-        report = ["Line names and number of stops:"]
+        yield "Line names and number of stops:"
         for bus_id in stops_report.keys():
-            report += ["bus_id: " +  f"{bus_id}, " + f"stops: {stops_report[bus_id]}"]
-        parsed_report = "\n".join(report)
-        return parsed_report
+            yield "\nbus_id: " + f"{bus_id}, " + f"stops: {stops_report[bus_id]}"
 
     if format_type == "stage_two":
-        report = [f"Format validation: {tot_err} errors"]
+        yield f"Format validation: {tot_err} errors"
         for field in ["stop_name", "stop_type", "a_time"]:
-            report += [field + ": " + f"{ezrider.total_errors_dict[field]}"]
-        parsed_report = "\n".join(report)
-        return parsed_report
+            yield "\n" + field + ": " + f"{ezrider.total_errors_dict[field]}"
 
     if format_type == "stage_one":
-        report = [f"Type and required field validation: {tot_err} errors"]
+        yield f"Type and required field validation: {tot_err} errors"
         for field in ezrider.fields:
-            report += [field + ": " + f"{ezrider.total_errors_dict[field]}"]
-        parsed_report = "\n".join(report)
-        return parsed_report
+            yield "\n" + field + ": " + f"{ezrider.total_errors_dict[field]}"
+
+    if format_type == "timing":
+        timing_stats = ezrider.timing_stats
+        yield "Travel time statistics:"
+        for bus_id, duration in timing_stats.line_durations.items():
+            line_summary = timing_stats.line_sketches[bus_id].summary()
+            yield (f"\nbus_id line {bus_id}: duration {duration} min, "
+                   f"between stops median {line_summary['median']}, "
+                   f"p95 {line_summary['p95']}, p99 {line_summary['p99']}")
+        segments_summary = timing_stats.all_segments_sketch().summary()
+        yield (f"\nsegments: {len(timing_stats.segment_sketches)}, median {segments_summary['median']}, "
+               f"p95 {segments_summary['p95']}, p99 {segments_summary['p99']}")
+        durations_summary = timing_stats.duration_sketch.summary()
+        yield (f"\nline durations: median {durations_summary['median']}, "
+               f"p95 {durations_summary['p95']}, p99 {durations_summary['p99']}")
+
+def iter_report_rows(format_type, ezrider, tot_err=0, stops_report=0):
+    """ the report of a stage as rows of plain values, one dict per row"""
+    if format_type in ("stage_one", "stage_two"):
+        yield {"field": "all", "errors": tot_err}
+        fields = ezrider.fields if format_type == "stage_one" else ["stop_name", "stop_type", "a_time"]
+        for field in fields:
+            yield {"field": field, "errors": ezrider.total_errors_dict[field]}
+    elif format_type == "stage_three":
+        for bus_id, stops in stops_report.items():
+            yield {"bus_id": bus_id, "stops": stops}
+    elif format_type == "stage_four":
+        for stop_type in ("S", "T", "F"):
+            for stop_name in ezrider.stops_sepcifier_report[stop_type]:
+                yield {"stop_type": stop_type, "stop_name": stop_name}
+    elif format_type == "stage_five":
+        for bus_id, stop_name in ezrider.time_anomalies.items():
+            if stop_name != []:
+                yield {"bus_id": bus_id, "stop_name": stop_name}
+    elif format_type == "stage_six":
+        for stop_name in ezrider.on_demand_faults:
+            yield {"stop_name": stop_name}
+    elif format_type == "timing":
+        for bus_id, duration in ezrider.timing_stats.line_durations.items():
+            line_summary = ezrider.timing_stats.line_sketches[bus_id].summary()
+            yield {"bus_id": bus_id, "duration": duration, "median": line_summary["median"],
+                   "p95": line_summary["p95"], "p99": line_summary["p99"]}
+
+def report_format(format_type, ezrider, stop_time_validation_report=0, tot_err=0, stops_report=0):
+    parsed_report = "".join(iter_text_report(format_type, ezrider, tot_err=tot_err, stops_report=stops_report))
+    return parsed_report
 
+
+class ReportWriter:
+    """ writes stage reports to a stream (a file, or a socket's makefile) piece by piece, so a report is never
+    held in memory as a whole. formats are text (as report_format), json (an array of {"stage", "rows"} objects),
+    ndjson (a line per row) and csv (one header line with the columns of every stage, then the rows of every
+    report, with an empty row for a report that has none)"""
+    formats = ("text", "json", "ndjson", "csv")
+    csv_columns = ("stage", "field", "errors", "bus_id", "stops", "stop_type", "stop_name")
+
+    def __init__(self, stream, output_format="text"):
+        if output_format not in self.formats:
+            raise ValueError(f"unknown report format: {output_format}")
+        self.stream = stream
+        self.output_format = output_format
+        self.reports_written = 0
+        self.csv_writer = (csv.DictWriter(stream, self.csv_columns, restval="", lineterminator="\n")
+                           if output_format == "csv" else None)
+
+    def write_report(self, format_type, ezrider, tot_err=0, stops_report=0):
+        if self.output_format == "text":
+            for piece in iter_text_report(format_type, ezrider, tot_err=tot_err, stops_report=stops_report):
+                self.stream.write(piece)
+            self.stream.write("\n")
+        elif self.output_format == "json":
+            self.stream.write(("[" if not self.reports_written else ",\n") + f'{{"stage": {json.dumps(format_type)}, "rows": [')
+            for index, row in enumerate(iter_report_rows(format_type, ezrider, tot_err, stops_report)):
+                self.stream.write((", " if index else "") + json.dumps(row))
+            self.stream.write("]}")
+        elif self.output_format == "ndjson":
+            for row in iter_report_rows(format_type, ezrider, tot_err, stops_report):
+                self.stream.write(json.dumps(dict(stage=format_type, **row)) + "\n")
+        else:
+            if not self.reports_written:
+                self.csv_writer.writeheader()
+            rows = 0
+            for rows, row in enumerate(iter_report_rows(format_type, ezrider, tot_err, stops_report), 1):
+                self.csv_writer.writerow(dict(row, stage=format_type))
+            if not rows:
+                # the stage ran and found nothing to report
+                self.csv_writer.writerow({"stage": format_type})
+        self.reports_written += 1
+
+    def close(self):
+        """ finish the output, the stream itself is left open"""
+        if self.output_format == "json":
+            self.stream.write("]\n" if self.reports_written else "[]\n")
+        elif self.output_format == "csv" and not self.reports_written:
+            self.csv_writer.writeheader()
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@cached_stage
 def stage_one(user_input):
     ezrider = EzRider(user_input)
     ezrider.total_report_errors_found()
@@ -422,6 +2324,7 @@ def stage_one(user_input):
     parsed_report = report_format("stage_one", ezrider, tot_err=tot_err)
     return parsed_report
 
+@cached_stage
 def stage_two(user_input):
     ezrider = EzRider(user_input)
     ezrider.total_report_errors_found()
@@ -429,12 +2332,14 @@ def stage_two(user_input):
     parsed_report = report_format("stage_two", ezrider, tot_err=tot_err)
     return parsed_report
 
+@cached_stage
 def stage_three(user_input):
     ezrider = EzRider(user_input)
     stops_report = ezrider.stops_counter(stand_alone=True)
     parsed_report = report_format("stage_three", ezrider, stops_report=stops_report)
     return parsed_report
 
+@cached_stage
 def stage_four(user_input):
     ezrider = EzRider(user_input)
     ezrider.stops_sepcifier()
@@ -442,21 +2347,221 @@ def stage_four(user_input):
     parsed_report = report_format("stage_four", ezrider)
     return parsed_report
 
+@cached_stage
 def stage_five(user_input):
     ezrider = EzRider(user_input)
     ezrider.stops_time_validation()
     parsed_report = report_format("stage_five", ezrider)
     return parsed_report
 
+@cached_stage
 def stage_six(user_input):
     ezrider = EzRider(user_input)
     ezrider.validate_on_demand_stops()
     parsed_report = report_format("stage_six", ezrider)
     return parsed_report
 
-if __name__ == '__main__':
+def stage_timing(user_input):
+    ezrider = EzRider(user_input)
+    ezrider.timing_statistics()
+    parsed_report = report_format("timing", ezrider)
+    return parsed_report
+
+def audit_shard(indexed_records, schema=None, error_samples=0, first_errors=10, memo_size=0):
+    """ audit a shard of (index, record) pairs in a worker process"""
+    ezrider = EzRider([], schema=schema, error_samples=error_samples, first_errors=first_errors, memo_size=memo_size)
+    memo_before = ezrider.validator_memo.stats() if memo_size else {}
+    ezrider.start_audit()
+    for index, data_point in indexed_records:
+        ezrider.audit_record(index, data_point)
+    state = ezrider.audit_state()
+    if memo_size:
+        # the memo lives as long as the worker, only the lookups of this shard are reported
+        state["memo_stats"] = {inp_field: {count: field_stats[count] - memo_before[inp_field][count]
+                                           for count in ("hits", "misses")}
+                               for inp_field, field_stats in ezrider.validator_memo.stats().items()}
+    return state
+
+@cached_stage
+def stage_all(user_input, workers=None):
+    """ all six stage reports from a single parse and a single pass over the records.
+    with workers, the bus lines are checked in that many processes.
+    a failed stage is reported by the message of the error that stopped it"""
+    ezrider = EzRider(user_input)
+    if workers:
+        reports = ezrider.audit_parallel(workers)
+    else:
+        reports = ezrider.audit()
+    for stage, error in ezrider.audit_failures.items():
+        reports[stage] = str(error)
+    return {stage: reports[stage] for stage in STAGES}
+
+def iter_feed_paths(paths):
+    """ the given files, and the .json files found under the given directories"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, file_names in os.walk(path):
+            subdirectories.sort()
+            for file_name in sorted(file_names):
+                if file_name.endswith(".json"):
+                    yield os.path.join(directory, file_name)
+
+def validate_feed_file(path, stages=STAGES) -> dict:
+    """ the result line of a feed file: its stage reports, failed stages and timing.
+    a file that can not be read or parsed is reported with its error instead"""
+    start = time.perf_counter()
+    result = {"path": path}
     try:
-        report = stage_six(input())
-        print(report)
-    except BadBusException:
-        pass
+        with open(path) as feed_file:
+            ezrider = EzRider(feed_file)
+            reports = ezrider.audit()
+        result["reports"] = {stage: reports[stage] for stage in stages if stage in reports}
+        result["failures"] = {stage: f"{type(error).__name__}: {error}"
+                              for stage, error in ezrider.audit_failures.items() if stage in stages}
+    except Exception as error:  # one bad feed must not stop the batch
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def run_batch(paths, stages=STAGES, workers=None, output=None):
+    """ validate every feed file in worker processes and write one NDJSON line per feed as it finishes.
+    returns the number of feeds that could not be validated"""
+    output = output or sys.stdout
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(validate_feed_file, path, stages): path for path in iter_feed_paths(paths)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:  # e.g. a worker that died
+                result = {"path": futures[future], "error": f"{type(error).__name__}: {error}"}
+            failed += "error" in result
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    return failed
+
+class ForkServer:
+    """ a resident validator on a Unix socket, for callers that would spend more time starting Python than checking
+    their small feeds. every request is a JSON line {"paths": [...], "stages": [...]}, answered by a forked child
+    that already has everything imported and warmed up: one result line per feed, as run_batch writes them, then
+    {"server": {"startup_seconds", "fork_seconds", "feeds", "failed"}}. see easyrider_client.py"""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.listener = None
+        self.startup_seconds = None
+
+    def start(self):
+        start = time.perf_counter()
+        # run every stage once, so the children start with the checkers compiled and their caches filled
+        compile_schema(DEFAULT_SCHEMA, 0)
+        warm_up = EzRider(io.StringIO(WARM_UP_FEED))
+        warm_up.audit()
+        warm_up.stops_time_validation()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(64)
+        self.startup_seconds = time.perf_counter() - start
+        return self
+
+    def serve_forever(self):
+        # children are reaped by the system
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        # keep the warmed up objects out of the collector, so the children do not copy the pages they live on
+        gc.freeze()
+        while True:
+            connection, _ = self.listener.accept()
+            accepted = time.perf_counter()
+            if os.fork() == 0:
+                self.listener.close()
+                try:
+                    self.handle(connection, accepted)
+                finally:
+                    os._exit(0)
+            connection.close()
+
+    def handle(self, connection, accepted):
+        """ answer a request, in the forked child"""
+        fork_seconds = time.perf_counter() - accepted
+        with connection, connection.makefile("rw") as stream:
+            try:
+                request = json.loads(stream.readline())
+                stages = request.get("stages") or list(STAGES)
+                unknown = [stage for stage in stages if stage not in STAGES]
+                if unknown:
+                    raise ValueError(f"unknown stages: {', '.join(unknown)}")
+                paths = list(iter_feed_paths(request["paths"]))
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                stream.write(json.dumps({"error": f"{type(error).__name__}: {error}"}) + "\n")
+                return
+            failed = 0
+            for path in paths:
+                result = validate_feed_file(path, stages)
+                failed += "error" in result
+                stream.write(json.dumps(result) + "\n")
+            stream.write(json.dumps({"server": {"startup_seconds": self.startup_seconds, "fork_seconds": fork_seconds,
+                                                "feeds": len(paths), "failed": failed}}) + "\n")
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+# a feed touching every stage, for ForkServer.start
+WARM_UP_FEED = json.dumps([
+    {"bus_id": 1, "stop_id": 1, "stop_name": "Elm Street", "next_stop": 2, "stop_type": "S", "a_time": "08:00"},
+    {"bus_id": 1, "stop_id": 2, "stop_name": "Abbey Road", "next_stop": 3, "stop_type": "O", "a_time": "08:10"},
+    {"bus_id": 1, "stop_id": 3, "stop_name": "Fifth Avenue", "next_stop": 0, "stop_type": "F", "a_time": "08:20"},
+    {"bus_id": 2, "stop_id": 4, "stop_name": "Sunset Boulevard", "next_stop": 3, "stop_type": "S", "a_time": "09:00"},
+    {"bus_id": 2, "stop_id": 3, "stop_name": "Fifth Avenue", "next_stop": 0, "stop_type": "F", "a_time": "08:50"}])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="validate Easy Rider bus feeds. "
+                                                 "without paths, a feed is read from stdin and checked by stage six")
+    parser.add_argument("paths", nargs="*", help="feed files, or directories of .json feeds")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to report")
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--output", help="NDJSON file to write the results to, stdout by default")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="stay resident on this Unix socket and validate the feeds sent by easyrider_client.py")
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        if not hasattr(os, "fork"):
+            parser.error("--serve needs a system with fork")
+        server = ForkServer(args.serve).start()
+        print(f"ready on {args.serve}, warmed up in {server.startup_seconds * 1000:.1f} ms", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return 0
+
+    if not args.paths:
+        try:
+            report = stage_six(input())
+            print(report)
+        except BadBusException:
+            pass
+        return 0
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+    if args.output:
+        with open(args.output, "w") as output:
+            return 1 if run_batch(args.paths, stages, args.workers, output) else 0
+    return 1 if run_batch(args.paths, stages, args.workers) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())